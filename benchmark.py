@@ -0,0 +1,140 @@
+#%%
+'''
+Headless benchmark of the bundled designs
+    python benchmark.py --sizes 1 3 5 --output benchmark.jsonl
+
+every size n traces the System3D sources with fov_grid = spatial_grid = (n,n) and the K_domain sources
+with fov_grid = (2n+1,2n+1), one JSON record per (case, size, stage) is appended to the output file
+wall times come from a plain run, peak memory from a second run under tracemalloc (which slows python code down)
+'''
+import os
+import re
+import io
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+from contextlib import contextmanager, redirect_stdout
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from system import *
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+CASES = {'main': 'main.py',
+         'Block': 'case/Block.py',
+         'ML2': 'case/ML2.py',
+         'RGB_3layers': 'case/RGB_3layers.py'}
+
+@contextmanager
+def patched(patches):
+    #patches: [(owner, attribute, value)]
+    original = [(owner, name, getattr(owner, name)) for owner, name, _ in patches]
+    for owner, name, value in patches:
+        setattr(owner, name, value)
+    try:
+        yield
+    finally:
+        for owner, name, value in original:
+            setattr(owner, name, value)
+
+def measure(func, memory = True):
+    #return: result, wall time [s], peak traced memory [byte]
+    if memory:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func()
+    wall_time = time.perf_counter()-t0
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, wall_time, peak
+
+def build(case, size, memory = True):
+    '''
+    run the case script without windows, System3D.tracing and generate_graph
+    return: namespace of the script, records of K_domain.tracing and System_2D.estimate
+    '''
+    with open(os.path.join(ROOT, CASES[case])) as file:
+        source = file.read()
+    source = re.sub(r"'fov_grid':\s*\(\d+,\s*\d+\),(\s*)'spatial_grid':\s*\(\d+,\s*\d+\)",
+                    rf"'fov_grid':({size},{size}),\1'spatial_grid':({size},{size})", source)
+    source = re.sub(r"'fov_grid':\s*\(\d+,\s*\d+\)}", rf"'fov_grid':({2*size+1},{2*size+1})}}", source)
+
+    records = []
+    def timed(stage, method):
+        def wrapper(self, *args, **kwargs):
+            result, wall_time, peak = measure(lambda: method(self, *args, **kwargs), memory)
+            records.append({'stage': stage, 'wall_time': wall_time, 'peak_memory': peak})
+            return result
+        return wrapper
+
+    skip = lambda *args, **kwargs: None
+    namespace = {'__name__': f'benchmark_{case}'}
+    with patched([(plt, 'show', skip),
+                  (System3D, 'draw', skip), (System3D, 'draw_graph', skip),
+                  (System3D, 'tracing', skip), (System3D, 'generate_graph', skip),
+                  (K_domain, 'draw', skip), (System_2D, 'draw', skip), (System_2D, 'check', skip),
+                  (K_domain, 'tracing', timed('K_domain.tracing', K_domain.tracing)),
+                  (System_2D, 'estimate', timed('System_2D.estimate', System_2D.estimate))]):
+        with redirect_stdout(io.StringIO()):
+            exec(compile(source, CASES[case], 'exec'), namespace)
+    plt.close('all')
+    return namespace, records
+
+def stages(case, size, max_iter = 300, memory = False):
+    namespace, records = build(case, size, memory)
+    s3d = namespace['s3d']
+    _, wall_time, peak = measure(lambda: s3d.tracing(max_iter = max_iter), memory)
+    records.append({'stage': 'System3D.tracing', 'wall_time': wall_time, 'peak_memory': peak,
+                    'rays': int(sum(len(s3d.rays[w]) for w in s3d.rays)),
+                    'iterations': max([s3d.termination[job]['iterations'] for job in s3d.termination], default = 0)})
+    _, wall_time, peak = measure(lambda: s3d.generate_graph(), memory)
+    records.append({'stage': 'System3D.generate_graph', 'wall_time': wall_time, 'peak_memory': peak,
+                    'rays': int(sum(len(s3d.rays[w]) for w in s3d.rays)),
+                    'graphs': int(sum(len(s3d.graph[w]) for w in s3d.graph)),
+                    'vertices': int(sum(G.vcount() for w in s3d.graph for G in s3d.graph[w])),
+                    'edges': int(sum(G.ecount() for w in s3d.graph for G in s3d.graph[w]))})
+    return records
+
+def run_case(case, size, max_iter = 300, memory = True):
+    records = stages(case, size, max_iter)
+    if memory:
+        for record, traced in zip(records, stages(case, size, max_iter, memory = True)):
+            record['peak_memory'] = traced['peak_memory']
+    for record in records:
+        record.update({'case': case, 'fov_grid': size, 'spatial_grid': size, 'max_iter': max_iter,
+                       'kdomain_fov_grid': 2*size+1})
+    return records
+
+def commit_id():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT,
+                              capture_output = True, text = True).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Headless benchmark of the bundled designs')
+    parser.add_argument('--cases', nargs = '+', default = list(CASES), choices = list(CASES))
+    parser.add_argument('--sizes', nargs = '+', type = int, default = [1,3,5])
+    parser.add_argument('--max-iter', type = int, default = 300)
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the tracemalloc run')
+    parser.add_argument('--output', default = 'benchmark.jsonl')
+    args = parser.parse_args(argv)
+
+    commit = commit_id()
+    with open(args.output, 'a') as file:
+        for case in args.cases:
+            for size in args.sizes:
+                for record in run_case(case, size, args.max_iter, not args.no_memory):
+                    record.update({'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+                    file.write(json.dumps(record)+'\n')
+                    print(f"{case:12s} n={size} {record['stage']:24s} {record['wall_time']:8.3f} s",
+                          f"{record['peak_memory']/2**20:8.1f} MiB" if record['peak_memory'] is not None else '')
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,8 @@ def adapt_nparray(array_val):
     return array_val.tobytes()
 
 def convert_tuple(tuple_str):
+    #sqlite hands the stored text to the converters as bytes
+    tuple_str = tuple_str.decode() if isinstance(tuple_str, bytes) else tuple_str
     tuple_str = tuple_str.replace('(', '').replace(')', '').strip()
     return tuple(map(float, tuple_str.split(', ')))
 
@@ -134,6 +136,32 @@ class Datebase:
         self.cursor.execute(f'SELECT * FROM {table} {conditions}', values)
         return self.cursor.fetchall()
 
+    def jones_table(self, variable = {}):
+        '''
+        dense Jones table of the launches computed for the structure variable {name: value}
+        return: {in-direct: {'wavelength','theta','phi': grid, 'orders': [[out-direct,m,n]], 'jones': [order,wavelength,theta,phi,2,2]}}
+                launches missing on the grid are zero, direct 4/5 (rcwa_primary_direction +z/-z) are read as 1/-1
+        '''
+        conditions = ''.join([f' AND Variable.{item} = ?' for item in variable])
+        self.cursor.execute(f'''SELECT Launch.wavelength, Launch.direct, Launch.theta, Launch.phi, Jones.order_dmn, Jones.matrix
+                                FROM Jones JOIN Launch ON Jones.lid = Launch.lid JOIN Variable ON Jones.vid = Variable.vid
+                                WHERE 1{conditions}''', list(variable.values()))
+        rows = self.cursor.fetchall()
+        launch = np.asarray([row[:4] for row in rows], dtype = float).reshape((-1,4))
+        launch[:,1] = np.select([launch[:,1] == 4, launch[:,1] == 5], [1, -1], launch[:,1])
+        order = np.asarray([row[4] for row in rows], dtype = float).reshape((-1,3))
+        matrix = np.asarray([row[5] for row in rows], dtype = complex).reshape((-1,2,2))
+        table = {}
+        for direct in np.unique(launch[:,1]):
+            rows = launch[:,1] == direct
+            grid = [np.unique(launch[rows,i]) for i in (0,2,3)]
+            orders, order_i = np.unique(order[rows], axis = 0, return_inverse = True)
+            jones = np.zeros((len(orders), *[len(axis) for axis in grid], 2, 2), dtype = complex)
+            index = [np.searchsorted(axis, launch[rows,i]) for axis, i in zip(grid, (0,2,3))]
+            jones[(order_i.reshape(-1), *index)] = matrix[rows]
+            table[int(direct)] = {'wavelength': grid[0], 'theta': grid[1], 'phi': grid[2], 'orders': orders, 'jones': jones}
+        return table
+
     def close(self):
         self.connect.close()
 # %%
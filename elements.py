@@ -1,19 +1,135 @@
 #%%
+import time
 import numpy as np
 import matplotlib.path as mpath
 from copy import deepcopy
 
+#traced rays: [wavelength,kx,ky,kz,x0,y0,z0,x,y,z,eid,weight]
+#weight: 1 for the source rays, scaled by the order efficiencies and summed over merged rays, it is a power only
+#if the gratings give their efficiencies (with the default 1 it counts the merged paths and grows past 1)
+WEIGHT = 11
+#accumulated run time [s] of the hot spots inside the elements, read by the tracing profiler
+TIMER = {'unique_rays': 0.0}
+#polarized tracing: columns behind the weight column, Jones vector [Ep,Es] as [re,im,re,im] and the unit s vector [sx,sy,sz] of its basis
+JONES = WEIGHT+1
+POLARIZATION = 7
+
+def group_rows(rows, decimals = 6):
+    '''
+    group the equal rows by hashing the quantized rows
+    decimals: rows are compared after rounding to these decimals
+    return: index of the first row of every group, group id of every row, group sizes
+            the groups are numbered in the order of their first row
+    '''
+    keys = np.ascontiguousarray(np.round(rows*10**decimals).astype(np.int64))
+    hashes = np.zeros(len(rows), dtype = np.uint64)
+    for column in keys.view(np.uint64).T:
+        #splitmix64 finalizer of every column, combined FNV style
+        column = (column ^ (column >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        column = (column ^ (column >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        hashes = (hashes ^ column ^ (column >> np.uint64(31))) * np.uint64(0x100000001b3)
+    _, first, inverse, counts = np.unique(hashes, return_index = True, return_inverse = True, return_counts = True)
+    if np.any(keys[first][inverse] != keys):
+        #hash collision
+        _, first, inverse, counts = np.unique(keys, axis = 0, return_index = True, return_inverse = True, return_counts = True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)], counts[order]
+
+def unique_rays(rays, decimals = 6, weight = None, polarized = False):
+    '''
+    remove the repeated rays, the first ray of every group is kept in the input order
+    decimals: rows are compared after rounding to these decimals
+    weight: the weights of the merged rays are summed, this column and the ones after it 
+            (e.g. bounce counters) are not compared and are taken from the first merged ray
+    polarized: the polarization columns behind the weight are compared too, only rays in the same 
+               polarization state (Jones vector and phase) are merged
+    return: unique rays, multiplicity of every unique ray
+    '''
+    t0 = time.perf_counter()
+    compared = np.hstack((rays[:,:weight], rays[:,JONES:JONES+POLARIZATION])) if polarized else rays[:,:weight]
+    first, inverse, counts = group_rows(compared, decimals)
+    unique = rays[first]
+    if weight is not None:
+        unique[:,weight] = np.bincount(inverse, weights = rays[:,weight], minlength = len(first))
+    TIMER['unique_rays'] += time.perf_counter()-t0
+    return unique, counts
+
+def s_vector(k):
+    #unit s vector (normal to the plane of incidence on the z surfaces) of the k vectors [[kx,ky,kz]], y for normal incidence
+    s = np.column_stack((-k[:,1], k[:,0], np.zeros(len(k))))
+    norm = np.linalg.norm(s, axis = 1)
+    s[norm == 0] = [0,1,0]
+    return s/np.where(norm == 0, 1, norm)[:,np.newaxis]
+
+def plane_jones(rays):
+    #Jones vectors [[Ep,Es]] of the polarized rays in the s/p basis of their plane of incidence, p = k x s
+    k = rays[:,1:4]/np.linalg.norm(rays[:,1:4], axis = 1)[:,np.newaxis]
+    s0, s1 = rays[:,JONES+4:JONES+7], s_vector(rays[:,1:4])
+    p0, p1 = np.cross(k, s0), np.cross(k, s1)
+    rotation = np.einsum('nai,nbi->nab', np.stack((p1,s1), axis = 1), np.stack((p0,s0), axis = 1))
+    return np.einsum('nab,nb->na', rotation, rays[:,JONES:JONES+4:2]+1j*rays[:,JONES+1:JONES+4:2])
+
+def apply_jones(rays, matrix, jones):
+    '''
+    write matrix @ jones (normalized) and the s vector of the (outgoing) k into the polarization columns
+    matrix: [N,2,2] in the p/s basis, jones: [N,2] incoming [Ep,Es] in the plane of incidence (plane_jones)
+    return: |matrix @ jones|^2, the fraction of the power carried by the outgoing rays
+    '''
+    jones = np.einsum('nab,nb->na', matrix, jones)
+    power = np.sum(np.abs(jones)**2, axis = 1)
+    jones /= np.sqrt(np.where(power > 0, power, 1))[:,np.newaxis]
+    rays[:,JONES:JONES+4:2], rays[:,JONES+1:JONES+4:2] = jones.real, jones.imag
+    rays[:,JONES+4:JONES+7] = s_vector(rays[:,1:4])
+    return power
+
 class Material:
+    #maximum number of wavelengths kept in the index cache (least recently used are dropped)
+    cache_size = 256
+
     def __init__(self, name, coefficient):
         self.name = name
         self.coefficient = coefficient
+        #index cache: sorted wavelengths, their index and last use, shared by every element using this material
+        self._keys, self._values, self._used = np.empty(0), np.empty(0), np.empty(0, dtype = int)
+        self._tick = 0
 
     def sellmeier_equation(self,b1,b2,b3,c1,c2,c3,wavelength):
         square_n = 1+b1*wavelength**2/(wavelength**2-c1)+b2*wavelength**2/(wavelength**2-c2)+b3*wavelength**2/(wavelength**2-c3)
         return np.sqrt(square_n)
     
     def __call__(self,wavelength):
-        return self.sellmeier_equation(*self.coefficient,wavelength)
+        #the wavelength column is mapped to cache slots by searchsorted and the index is one gather
+        wavelength = np.asarray(wavelength, dtype = float)
+        if wavelength.size > 1 and wavelength.min() == wavelength.max():
+            return np.full(wavelength.shape, self(wavelength.flat[0]))
+        self._tick += 1
+        slot, found = self.lookup(wavelength)
+        if not found.all():
+            self._used[slot[found]] = self._tick
+            new = np.unique(wavelength[~found])
+            if len(new) <= self.cache_size:
+                self.remember(new)
+                slot, found = self.lookup(wavelength)
+            if not found.all():
+                return self.sellmeier_equation(*self.coefficient,wavelength)
+        self._used[slot] = self._tick
+        return self._values[slot][()]
+
+    def lookup(self, wavelength):
+        if len(self._keys) == 0:
+            return np.zeros(wavelength.shape, dtype = int), np.zeros(wavelength.shape, dtype = bool)
+        slot = np.minimum(np.searchsorted(self._keys, wavelength), len(self._keys)-1)
+        return slot, self._keys[slot] == wavelength
+
+    def remember(self, wavelength):
+        keys = np.concatenate((self._keys, wavelength))
+        values = np.concatenate((self._values, self.sellmeier_equation(*self.coefficient,wavelength)))
+        used = np.concatenate((self._used, np.full(len(wavelength), self._tick)))
+        keep = np.sort(np.argsort(-used, kind = 'stable')[:self.cache_size])
+        order = keep[np.argsort(keys[keep])]
+        self._keys, self._values, self._used = keys[order], values[order], used[order]
 
 class Rays_convert_tool:
     def __init__(self,material = Material('Air',[0,0,0,0,0,0]), 
@@ -28,75 +144,93 @@ class Rays_convert_tool:
         self.input_format = input_format
         self.output_format = output_format
 
-    def convert(self, ray):
+    def convert(self, ray, out = None, dtype = None):
+        '''
+        out: array for the converted rays, may be ray itself (in place), default: a copy of ray
+        dtype: computation dtype (e.g. np.float32 for very large grids), default: the dtype of out/ray
+        '''
         ray = np.asarray(ray)
-        index = self.index(ray[:,0])
+        dtype = np.dtype(dtype if dtype is not None else out.dtype if out is not None else 
+                         ray.dtype if ray.dtype.kind == 'f' else np.float64)
+        index = self.index(ray[:,0]).astype(dtype, copy = False)
         if self.input_format =='hv':
-            h,v,z = np.deg2rad(ray[:,1:4]).T
-            z = np.where(z>=0,1,-1)
-            kx = index*np.tan(h)/np.sqrt(1+np.tan(h)**2+np.tan(v)**2)
-            ky = index*np.tan(v)/np.sqrt(1+np.tan(h)**2+np.tan(v)**2)
-            kz = z*np.sqrt(index**2-kx**2-ky**2)
+            tan_h, tan_v = np.tan(np.deg2rad(ray[:,1:3].astype(dtype, copy = False))).T
+            kz = index/np.sqrt(1+tan_h**2+tan_v**2)
+            kx, ky = tan_h*kz, tan_v*kz
+            kz *= np.where(ray[:,3]>=0,1,-1).astype(dtype)
             
         elif self.input_format == 'sp':
-            theta,phi = np.deg2rad(ray[:,1:3]).T
-            kx = index*np.sin(theta)*np.cos(phi)
-            ky = index*np.sin(theta)*np.sin(phi)
+            theta,phi = np.deg2rad(ray[:,1:3].astype(dtype, copy = False)).T
+            sin_theta = index*np.sin(theta)
+            kx = sin_theta*np.cos(phi)
+            ky = sin_theta*np.sin(phi)
             kz = index*np.cos(theta)
         
         elif self.input_format == 'k':
-            index = np.sqrt(np.sum(ray[:,1:4]**2,axis = 1))
-            kx,ky,kz = ray[:,1:4].T
+            kx,ky,kz = ray[:,1:4].astype(dtype).T
+            index = np.sqrt(kx**2+ky**2+kz**2)
             
         else:
             print('format error')
             return None
 
-        ray_output = deepcopy(ray)
+        if out is None:
+            out = ray.astype(dtype)
+        elif out is not ray:
+            out[...] = ray
         if self.output_format =='hv':
-            ray_output[:,1] = np.rad2deg(np.arctan(kx/np.sqrt(index**2-kx**2-ky**2)))
-            ray_output[:,2] = np.rad2deg(np.arctan(ky/np.sqrt(index**2-kx**2-ky**2)))
-            ray_output[:,3] = np.where(kz>0,1,-1)
-            return ray_output
+            kz_abs = np.sqrt(index**2-kx**2-ky**2)
+            out[:,1] = np.rad2deg(np.arctan(kx/kz_abs))
+            out[:,2] = np.rad2deg(np.arctan(ky/kz_abs))
+            out[:,3] = np.where(kz>0,1,-1)
+            return out
 
         elif self.output_format =='sp':
-            ray_output[:,1] = np.rad2deg(np.arcsin(np.sqrt(kx**2+ky**2)/index))
-            ray_output[:,2] = np.rad2deg(np.arctan2(ky,kx))
-            ray_output[:,3] = np.where(kz>0,1,-1)
-            return ray_output
+            out[:,1] = np.rad2deg(np.arcsin(np.sqrt(kx**2+ky**2)/index))
+            out[:,2] = np.rad2deg(np.arctan2(ky,kx))
+            out[:,3] = np.where(kz>0,1,-1)
+            return out
              
         elif self.output_format =='k':
-            ray_output[:,1] = kx
-            ray_output[:,2] = ky
-            ray_output[:,3] = kz
-            return ray_output
+            out[:,1] = kx
+            out[:,2] = ky
+            out[:,3] = kz
+            return out
         else:
             print('format error')
             return None
         
+def halton(index, bases = (2,3,5,7)):
+    #points of the Halton sequence for the integer indices, one column (radical inverse) per base
+    points = np.zeros((len(index), len(bases)))
+    for j, base in enumerate(bases):
+        i, f = np.array(index, dtype = np.int64), 1.0
+        while np.any(i > 0):
+            f /= base
+            points[:,j] += f*(i % base)
+            i //= base
+    return points
+
 class Source:
     def __init__(self,fov,wavelength_list,
-                 fov_grid = (5,5),spatial_grid = (1,1), shape = [], z = 0, direct = 1):
+                 fov_grid = (5,5),spatial_grid = (1,1), shape = [], z = 0, direct = 1, dtype = np.float64,
+                 sampling = 'grid', samples = None):
+        '''
+        dtype: of the launched rays, np.float32 halves the memory of very large grids
+        sampling: 'grid': fov_grid x spatial_grid, 
+                  'halton', 'sobol': low discrepancy points over (x,y,h,v), only the ones inside the shape are kept
+        samples: number of low discrepancy points (default: as many as the grid), each is launched at every wavelength
+        '''
         self.name = 'Source'
         self.fov = np.asarray(fov)
         self.wavelength_list = np.asarray(wavelength_list)
         self.fgrid = np.asarray(fov_grid)
         self.sgrid = np.asarray(spatial_grid)
         self.z = z
-
-        x,y,h,v,w = np.meshgrid(np.linspace(0,1,self.sgrid[0]),
-                                np.linspace(0,1,self.sgrid[1]),
-                                np.linspace(*self.fov[:2],self.fgrid[0]),
-                                np.linspace(*self.fov[2:],self.fgrid[1]),
-                                self.wavelength_list)
-        self.field = np.vstack((w.reshape(-1),
-                                h.reshape(-1),
-                                v.reshape(-1), 
-                                direct*np.ones_like(h.reshape(-1)),
-                                x.reshape(-1),
-                                y.reshape(-1),
-                                z*np.ones_like(h.reshape(-1)),
-                                )).T
+        self.direct = direct
+        self.dtype = np.dtype(dtype)
+        self.sampling = sampling
+        self.samples = samples
         
         if len(shape) != 0:
             shape = np.asarray(shape)
@@ -104,20 +238,68 @@ class Source:
 
     def launch(self):
         #k_in: [[wavelength,kx,ky,kz,x,y,z,...]]
-        tool = Rays_convert_tool()
-        self.rays = deepcopy(self.field)
+        return np.vstack([np.empty((0,7), dtype = self.dtype)]+list(self.batches(None)))
+
+    def batches(self, size = 2**20):
+        '''
+        generate the launched rays lazily in batches of at most size rays (None: one batch)
+        grid: the spatial grid is masked by the shape first, then crossed with the fov and wavelength grid 
+              in the order of the full launch
+        '''
+        if self.sampling == 'grid':
+            x, y = np.meshgrid(np.linspace(0,1,self.sgrid[0]), np.linspace(0,1,self.sgrid[1]))
+            xy, inside = self.aperture(np.column_stack((x.reshape(-1), y.reshape(-1))), np.all(self.sgrid != [1,1]))
+            h, v, w = [column.reshape(-1) for column in np.meshgrid(np.linspace(*self.fov[:2],self.fgrid[0]),
+                                                                   np.linspace(*self.fov[2:],self.fgrid[1]),
+                                                                   self.wavelength_list, indexing = 'ij')]
+            xy = xy[inside]
+            total = len(xy)*len(w)
+            size = size or max(total, 1)
+            for start in range(0, total, size):
+                point, angle = np.divmod(np.arange(start, min(start+size, total)), len(w))
+                yield self.ray_batch(w[angle], h[angle], v[angle], xy[point])
+        elif self.sampling in ('halton', 'sobol'):
+            samples = self.samples or int(np.prod(self.fgrid)*np.prod(self.sgrid))
+            wavelengths = len(self.wavelength_list)
+            chunk = max((size or samples*wavelengths)//wavelengths, 1)
+            if self.sampling == 'sobol':
+                from scipy.stats import qmc
+                sampler = qmc.Sobol(d = 4, scramble = False)
+            done, drawn = 0, 1
+            while done < samples and drawn < 1000*samples:
+                #Sobol points are drawn in powers of 2 to keep their balance
+                n = 2**int(np.ceil(np.log2(chunk))) if self.sampling == 'sobol' else chunk
+                u = sampler.random(n) if self.sampling == 'sobol' else halton(np.arange(drawn, drawn+n))
+                drawn += n
+                xy, inside = self.aperture(u[:,:2], True)
+                u, xy = u[inside][:samples-done], xy[inside][:samples-done]
+                done += len(u)
+                if len(u):
+                    h = self.fov[0]+u[:,2]*(self.fov[1]-self.fov[0])
+                    v = self.fov[2]+u[:,3]*(self.fov[3]-self.fov[2])
+                    yield self.ray_batch(np.tile(self.wavelength_list, len(u)), np.repeat(h, wavelengths), 
+                                    np.repeat(v, wavelengths), np.repeat(xy, wavelengths, axis = 0))
+        else:
+            print('sampling error')
+
+    def aperture(self, xy, masked):
+        #place the unit square points xy on the bounding box of the shape, return: positions, inside the shape
+        inside = np.ones(len(xy), dtype = bool)
         if hasattr(self,'polygon'):
             box = np.vstack((self.polygon.vertices.min(axis = 0),
                              self.polygon.vertices.max(axis = 0))).T
             wx,wy = np.max(box,axis = 1) - np.min(box,axis = 1)
             xc,yc = (np.max(box,axis = 1) + np.min(box,axis = 1))/2
-            self.rays[:,4] = wx*self.rays[:,4]- wx/2 + xc
-            self.rays[:,5] = wy*self.rays[:,5]- wy/2 + yc
-            self.rays[:,4:7] = np.round(self.rays[:,4:7],4)
-            if wx!=0 and wy != 0 and np.all(self.sgrid != [1,1]):
-                mask = self.polygon.contains_points(self.rays[:,4:6], radius=1E-3)
-                self.rays = self.rays[mask]
-        k_out = tool.convert(self.rays)
+            xy = np.round(xy*[wx,wy] + [xc-wx/2, yc-wy/2],4)
+            if wx!=0 and wy != 0 and masked:
+                inside = self.polygon.contains_points(xy, radius=1E-3)
+        return xy, inside
+
+    def ray_batch(self, w, h, v, xy):
+        rays = np.empty((len(w), 7), dtype = self.dtype)
+        rays[:,0], rays[:,1], rays[:,2], rays[:,3], rays[:,4:6] = w, h, v, self.direct, xy
+        rays[:,6] = np.round(self.z,4) if hasattr(self,'polygon') else self.z
+        k_out = Rays_convert_tool().convert(rays, out = rays)
         k_out[:,1:4] = np.round(k_out[:,1:4],6)
         return k_out
         
@@ -127,66 +309,145 @@ class Grating:
                  diffract_order = { 1:[[ 1,-1,0],[ 1,0,0],[ 1,1,0],
                                        [-1,-1,0],[-1,0,0],[-1,1,0]],
                                    -1:[[ 1,-1,0],[ 1,0,0],[ 1,1,0],
-                                       [-1,-1,0],[-1,0,0],[-1,1,0]]}):
+                                       [-1,-1,0],[-1,0,0],[-1,1,0]]},
+                 jones = None):
         ''' 
         #index
         [Material_1,material_2]
         if the ray's direction is positive, the ray propagates from Material_1 to Material_2
         if the ray's direction is negative, the ray propagates from Material_2 to Material_1
         #diffract_order
-        {in-direct:[[out-direct,m_order,n_order]]}
+        {in-direct:[[out-direct,m_order,n_order]]} or {in-direct:[[out-direct,m_order,n_order,efficiency]]}
         in-direct:  +z=1, -z=-1
         out-direct: +z=1, -z=-1
+        efficiency: fraction of the incident power carried by the order (default 1, every order keeps the full weight)
         if in-direct = out-direct, diffractive mode is transmission mode
         if in-direct != out-direct, diffractive mode is reflection mode
         #mode
         All: (default) Calculate all diffraction behavior if it is set in 'diffract_order'.
         T&TIR: Only calculate T-order diffraction behavior unless the R-order diffraction behavior is within the TIR region..
+        #jones (polarized tracing)
+        {(in-direct,out-direct,m_order,n_order): 2x2 Jones matrix or function(k_in,k_out) -> [N,2,2]}
+        the matrices map [Ep,Es] in the plane of incidence of k_in to the one of k_out, k: [[wavelength,kx,ky,kz]]
+        orders without a matrix keep the polarization, sqrt(efficiency)*identity
         '''
         self.name = name
         self.index = index
         self.periods = np.asarray(periods)
         self.diffract_order = diffract_order
         self.mode = mode
+        self.jones = jones
 
     def __setattr__(self, name, value):
         super().__setattr__(name, value)
+        if name in ('periods', 'diffract_order', 'index', 'mode'):
+            #{wavelength: {in-direct: order table}} of prune, stale once the grating changes
+            self._candidates = {}
         if name == 'periods':
             if self.periods.shape != (2,2):
                 self.periods = np.vstack((self.periods.reshape((1,2)),[np.inf,0]))
             g_phi = np.deg2rad(self.periods[:,1])
             self.g_vectors = (1/self.periods[:,0]*np.array([np.cos(g_phi),np.sin(g_phi)])).T
+        if name in ('periods', 'diffract_order') and hasattr(self, 'g_vectors') and hasattr(self, 'diffract_order'):
+            #{in-direct: (out-direct, order g-vector [[m*gv1+n*gv2]], efficiency, [[m,n]])}
+            self._orders = {}
+            for in_direct, diff_order in self.diffract_order.items():
+                diff_order = np.asarray(diff_order, dtype = float).reshape((len(diff_order), -1)) if len(diff_order) else np.empty((0,3))
+                self._orders[in_direct] = (diff_order[:,0], diff_order[:,1:3] @ self.g_vectors,
+                                           diff_order[:,3] if diff_order.shape[1] > 3 else np.ones(len(diff_order)),
+                                           diff_order[:,1:3])
+
+    def jones_matrix(self, in_direct, order, k_in, k_out):
+        #Jones matrices [N,2,2] of the (ray, order) pairs, order: rows of diffract_order[in_direct]
+        out_direct, _, efficiency, mn = [column[order] for column in self._orders[in_direct]]
+        matrix = np.sqrt(efficiency)[:,np.newaxis,np.newaxis]*np.eye(2, dtype = complex)
+        for (i_direct, o_direct, m, n), value in (self.jones or {}).items():
+            rows = (i_direct == in_direct) & (out_direct == o_direct) & (mn[:,0] == m) & (mn[:,1] == n)
+            if np.any(rows):
+                matrix[rows] = value(k_in[rows,:4], k_out[rows,:4]) if callable(value) else value
+        return matrix
+
+    def order_efficiency(self, in_direct, order, k_in, k_out):
+        #fraction of the (unpolarized) power carried by the (ray, order) pairs
+        return self._orders[in_direct][2][order]
 
-    def launched(self, k_in):
+    def prune(self, wavelength, cells = 64):
+        '''
+        tabulate the orders that can propagate for the incident rays of this wavelength in every k-space cell,
+        launched then only expands these orders (the same k-space picture as K_domain)
+        the table is conservative: an order is dropped from a cell only if it is evanescent, or blocked by T&TIR,
+        for every incident (kx,ky) of the cell
+        cells: number of cells per axis over the square |kx|,|ky| <= the larger index of the two materials
+        '''
+        n = np.array([self.index[0](wavelength), self.index[1](wavelength)]).ravel()
+        radius, margin = np.max(n), 1E-9
+        edges = np.linspace(-radius, radius, cells+1)
+        lower, upper = edges[:-1]-margin, edges[1:]+margin
+        #the cells farther than 1 from the origin somewhere, needed by the T&TIR reflection orders
+        far = np.maximum(np.abs(lower), np.abs(upper))
+        TIR = far[:,np.newaxis]**2+far**2 >= 1
+        self._candidates[wavelength] = {}
+        for in_direct, (out_direct, order_gv, _, _) in self._orders.items():
+            #distance of the cells to the points -wavelength*g where the order leaves the k-space at (0,0)
+            center = -wavelength*order_gv  #[order,(kx,ky)]
+            distance = [np.maximum(np.maximum(lower[:,np.newaxis]-center[:,axis], center[:,axis]-upper[:,np.newaxis]), 0)
+                        for axis in range(2)]  #[cell,order]
+            n_out = np.where(out_direct>0, n[1], n[0])
+            candidate = distance[0][:,np.newaxis]**2+distance[1]**2 < n_out**2  #[cell_x,cell_y,order]
+            if self.mode == 'T&TIR':
+                candidate &= TIR[:,:,np.newaxis] | (out_direct == in_direct)
+            self._candidates[wavelength][in_direct] = (edges[0], edges[1]-edges[0], candidate)
+
+    def candidates(self, in_direct, k_in):
+        #[ray,order] orders of diffract_order[in_direct] that may propagate, every order without a table of prune
+        table = self._candidates.get(k_in[0,0], {}).get(in_direct)
+        if table is None or np.any(k_in[:,0] != k_in[0,0]):
+            return np.ones((len(k_in), len(self._orders[in_direct][0])), dtype = bool)
+        start, size, candidate = table
+        cell = np.floor((k_in[:,1:3]-start)/size).astype(int)
+        inside = np.all((cell >= 0) & (cell < len(candidate)), axis = 1)
+        cell = np.clip(cell, 0, len(candidate)-1)
+        candidate = candidate[cell[:,0],cell[:,1]]
+        candidate[~inside] = True
+        return candidate
+
+    def launched(self, k_in, polarized = False):
         #k_in: [[wavelength,kx,ky,kz,x,y,z,...]]
-        k_out = []
-        for in_direct in self.diffract_order.keys():
-            kray = deepcopy(k_in[np.where(k_in[:,3]>0,1,-1) == in_direct])
-            if kray.size != 0:
-                diff_order = np.asarray(self.diffract_order[in_direct])
-                order_gv = diff_order[:,-2:] @ self.g_vectors  #[[m,n]] @ [gv1,gv2] = [[m*gv1+n*gv2]]
-                kray,order_gv,out_direct = (np.repeat(kray,len(order_gv),axis = 0),
-                                        np.tile(order_gv,(len(kray),1)),
-                                        np.tile(diff_order[:,0],(len(kray))))
-                if self.mode == 'T&TIR':
-                    TIR = (kray[:,1]**2+kray[:,2]**2) >= 1
-                    Transmission = out_direct == in_direct
-                    
-                n_out = np.where(out_direct>0,self.index[1](kray[:,0]),self.index[0](kray[:,0]))
-                kray[:,1:3] += kray[:,0:1]*order_gv
-                k2xy = kray[:,1]**2+kray[:,2]**2
-                k2z = n_out**2-k2xy
-                exist = k2z>0
-                if self.mode == 'T&TIR':
-                    exist[np.all([~TIR,~Transmission],axis = 0)] = False 
-                kray[exist,3] = np.where(out_direct[exist]>0,1,-1)*np.sqrt(k2z[exist])
-                k_out += [kray[exist]]
-        if k_out:
-            k_out  = np.vstack(k_out)
+        #the (ray, order) pairs allowed by the order table of prune are evaluated at once, only the propagating 
+        #ones are written to the output
+        #polarized: k_in carries the polarization columns, the power follows the Jones matrices instead of the efficiency
+        direct = np.where(k_in[:,3]>0,1,-1)
+        hits = []
+        for in_direct, (out_direct, order_gv, _, _) in self._orders.items():
+            kray = k_in[direct == in_direct]
+            if kray.size == 0 or out_direct.size == 0:
+                continue
+            ray, order = np.nonzero(self.candidates(in_direct, kray))
+            kxy = kray[ray,1:3]+kray[ray,0:1]*order_gv[order]
+            n_out = np.where(out_direct[order]>0, self.index[1](kray[:,0])[ray], self.index[0](kray[:,0])[ray])
+            k2z = n_out**2-kxy[:,0]**2-kxy[:,1]**2
+            exist = k2z>0
+            if self.mode == 'T&TIR':
+                TIR = (kray[ray,1]**2+kray[ray,2]**2) >= 1
+                Transmission = out_direct[order] == in_direct
+                exist &= TIR | Transmission
+            hits += [(in_direct, kray, kxy[exist], k2z[exist], out_direct, ray[exist], order[exist])]
+        k_out = np.empty((sum(len(ray) for *_, ray, _ in hits), k_in.shape[1]))
+        start = 0
+        for in_direct, kray, kxy, k2z, out_direct, ray, order in hits:
+            out = k_out[start:start+len(ray)]
+            np.take(kray, ray, axis = 0, out = out)
+            out[:,1:3] = kxy
+            out[:,3] = np.where(out_direct[order]>0,1,-1)*np.sqrt(k2z)
+            if polarized:
+                matrix = self.jones_matrix(in_direct, order, kray[ray], out)
+                out[:,WEIGHT] *= apply_jones(out, matrix, plane_jones(kray[ray]))
+            elif k_in.shape[1] > WEIGHT:
+                out[:,WEIGHT] *= self.order_efficiency(in_direct, order, kray[ray], out)
+            start += len(ray)
+        if len(k_out):
             k_out[:,1:4] = np.round(k_out[:,1:4],6)
-            k_out = np.unique(k_out,axis = 0)
-        else:
-            k_out = np.empty((0, k_in.shape[1]))
+            k_out, _ = unique_rays(k_out, weight = WEIGHT if k_out.shape[1] > WEIGHT else None, polarized = polarized)
         return k_out
     
     def launched_k(self,k_in,order,material_i):
@@ -207,6 +468,81 @@ class Grating:
         return kray#np.unique(kray,axis = 0)
         
 
+class Jones_grating(Grating):
+    def __init__(self, name, periods, index, table, mode = 'All'):
+        '''
+        grating whose orders carry the tabulated Jones matrices (e.g. from RCWA), interpolated multilinearly
+        over (wavelength, theta, phi) of the incident ray, theta: polar angle to the z axis, phi: azimuth [deg]
+        (wavelength and theta outside the grid are clamped to it, phi is periodic: the phi grid is one turn, 
+        e.g. [0,360) or [-180,180], and the rays between its last and first value are interpolated across the seam)
+        #table
+        {in-direct: {'wavelength': [], 'theta': [], 'phi': [], 'orders': [[out-direct,m_order,n_order]],
+                     'jones': [order,wavelength,theta,phi,2,2] complex, [Ep,Es] in -> [Ep,Es] out}}
+        the orders of the table are the diffract_order of the grating, unpolarized tracing uses the mean power 
+        |J|^2/2 of the two polarizations, orders set by a kpath that are not in the table fall back to Grating
+        '''
+        self.table = {in_direct: {name: np.asarray(value) for name, value in entry.items()} for in_direct, entry in table.items()}
+        super().__init__(name, periods, index, mode, 
+                         diffract_order = {in_direct: self.table[in_direct]['orders'].tolist() for in_direct in self.table})
+
+    @classmethod
+    def from_database(cls, name, periods, index, database, variable = {}, mode = 'All'):
+        #database: Datebase of the RCWA results, variable: {name: value} of the grating structure
+        return cls(name, periods, index, database.jones_table(variable), mode)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ('table', 'diffract_order') and hasattr(self, 'table') and hasattr(self, '_orders'):
+            #row of the table for every order of diffract_order, -1 if the table has no such order
+            self._rows = {}
+            for in_direct, (out_direct, _, _, mn) in self._orders.items():
+                orders = self.table[in_direct]['orders'] if in_direct in self.table else np.empty((0,3))
+                match = np.all(orders[np.newaxis] == np.column_stack((out_direct, mn))[:,np.newaxis], axis = 2)
+                self._rows[in_direct] = np.where(match.any(axis = 1), match.argmax(axis = 1), -1)
+
+    def interpolate(self, in_direct, row, k_in):
+        #Jones matrices [N,2,2] of the table rows interpolated at the incident rays k_in
+        entry = self.table[in_direct]
+        theta = np.rad2deg(np.arctan2(np.hypot(k_in[:,1], k_in[:,2]), np.abs(k_in[:,3])))
+        phi = np.rad2deg(np.arctan2(k_in[:,2], k_in[:,1]))
+        #flat index of the lower corner of every cell, index steps to the upper corners and (1-t, t) weights
+        stride = np.cumprod((1,)+entry['jones'].shape[3:0:-1])[::-1]
+        base, step, weight = row*stride[0], [], []
+        for axis, (grid, x) in enumerate(zip((entry['wavelength'], entry['theta'], entry['phi']), (k_in[:,0], theta, phi))):
+            if axis == 2:
+                #azimuth wrapped into [phi_0, phi_0+360), the last cell closes the turn back to phi_0
+                x = grid[0]+np.mod(x-grid[0], 360)
+                i = np.searchsorted(grid, x, side = 'right')-1
+                j = (i+1) % len(grid)
+                t = np.clip((x-grid[i])/(np.where(i == len(grid)-1, grid[0]+360, grid[j])-grid[i]), 0, 1)
+            else:
+                i = np.clip(np.searchsorted(grid, x, side = 'right')-1, 0, max(len(grid)-2, 0))
+                j = np.minimum(i+1, len(grid)-1)
+                t = np.clip((x-grid[i])/np.where(j > i, grid[j]-grid[i], 1), 0, 1)
+            base = base+i*stride[axis+1]
+            step += [(j-i)*stride[axis+1]]
+            weight += [(1-t, t)]
+        jones = np.ascontiguousarray(entry['jones'], dtype = complex).reshape((-1,4)).view(float)  #(re,im) pairs
+        matrix, value = np.zeros((len(row),8)), np.empty((len(row),8))
+        for corner in range(8):
+            upper = [corner >> axis & 1 for axis in range(3)]
+            index = base+sum(step[axis] for axis in range(3) if upper[axis])
+            np.take(jones, index, axis = 0, out = value)
+            value *= (weight[0][upper[0]]*weight[1][upper[1]]*weight[2][upper[2]])[:,np.newaxis]
+            matrix += value
+        return matrix.view(complex).reshape((-1,2,2))
+
+    def jones_matrix(self, in_direct, order, k_in, k_out):
+        matrix = super().jones_matrix(in_direct, order, k_in, k_out)
+        row = self._rows[in_direct][order]
+        tabulated = row >= 0
+        if np.any(tabulated):
+            matrix[tabulated] = self.interpolate(in_direct, row[tabulated], k_in[tabulated])
+        return matrix
+
+    def order_efficiency(self, in_direct, order, k_in, k_out):
+        return np.sum(np.abs(self.jones_matrix(in_direct, order, k_in, k_out))**2, axis = (1,2))/2
+
 class Fresnel_loss:
     def __init__(self, name, index):
         self.name = name
@@ -225,18 +561,31 @@ class Fresnel_loss:
         t_matrix = np.array([[ tp,zero],[zero,ts]])
         return np.hstack((r_matrix,t_matrix)).T.reshape((-1,2,2,2))
 
-    def launched(self,k_in):
+    def launched(self,k_in, polarized = False):
         #k_in: [[wavelength,kx,ky,kz,x,y,z,...]]
+        #polarized: k_in carries the polarization columns, the r/t Jones matrices are applied to them
         n_out = np.where(k_in[:,3]>0,self.index[1](k_in[:,0]),self.index[0](k_in[:,0]))
         n_in = np.where(k_in[:,3]>0,self.index[0](k_in[:,0]),self.index[1](k_in[:,0]))
         Tkz2 = n_out**2-(k_in[:,1]**2+k_in[:,2]**2)
         Rkz2 = n_in**2-(k_in[:,1]**2+k_in[:,2]**2)
         Rk_out, Tk_out = k_in[Tkz2<0], k_in[Tkz2>0]
+        if polarized:
+            #transmitted power 1-|rE|^2, the reflected part is lost; TIR keeps the power and only changes the phases
+            rt = self.__fresnel_k(n_in[Tkz2>0], n_out[Tkz2>0], k_in[Tkz2>0,1:4])
+            jones = plane_jones(Tk_out)
+            Tk_out[:,WEIGHT] *= 1-np.sum(np.abs(np.einsum('nab,nb->na', rt[:,0], jones))**2, axis = 1)
+            apply_jones(Tk_out, rt[:,1], jones)
+            rt = self.__fresnel_k(n_in[Tkz2<0], n_out[Tkz2<0], k_in[Tkz2<0,1:4])
+            apply_jones(Rk_out, rt[:,0], plane_jones(Rk_out))
+        elif k_in.shape[1] > WEIGHT:
+            #unpolarized transmittance, the reflected part is lost
+            rt = self.__fresnel_k(n_in[Tkz2>0], n_out[Tkz2>0], k_in[Tkz2>0,1:4])
+            Tk_out[:,WEIGHT] *= 1-np.mean(np.abs(rt[:,0,[0,1],[0,1]])**2, axis = 1)
         Tk_out[:,3] = (np.where(k_in[:,3]>0,1,-1)[Tkz2>0]*np.sqrt(Tkz2[Tkz2>0]))
         Rk_out[:,3] = (-np.where(k_in[:,3]>0,1,-1)[Tkz2<0]*np.sqrt(Rkz2[Tkz2<0]))
         k_out = np.vstack((Rk_out,Tk_out))
-        k_out = np.unique(k_out,axis = 0)
         k_out[:,1:4] = np.round(k_out[:,1:4],6)
+        k_out, _ = unique_rays(k_out, weight = WEIGHT if k_out.shape[1] > WEIGHT else None, polarized = polarized)
         return k_out
 
 class ColorFilter:
@@ -244,7 +593,7 @@ class ColorFilter:
         self.name = name
         self.stop_wavelength = stop_wavelength
 
-    def launched(self, k_in):
+    def launched(self, k_in, polarized = False):
         #k_in: [[wavelength,kx,ky,kz,x,y,z,...]]
         if k_in.size>0:
             k_out = k_in[k_in[:,0]!=self.stop_wavelength]
@@ -253,14 +602,54 @@ class ColorFilter:
         return k_out
 
 class Receiver:
-    def __init__(self,name):
+    def __init__(self,name, bins = None, ranges = None):
+        '''
+        bins: histogram mode, (nx,ny,nh,nv,nw) bins over the hit position x,y, the field angle h,v [deg] and the wavelength, 
+              the weight of the hits is accumulated as they arrive instead of storing the rays
+        ranges: [[min,max]] of x,y,h,v,wavelength, hits outside are not counted
+        '''
         self.name = name
         self.store = []
+        self.bins = None if bins is None else tuple(bins)
+        self.ranges = None if ranges is None else np.asarray(ranges, dtype = float)
+        if self.bins is not None and (len(self.bins) != 5 or self.ranges is None or self.ranges.shape != (5,2)):
+            print('histogram ranges error')
+            self.bins = None
+        self.histogram = None if self.bins is None else np.zeros(self.bins)
 
-    def launched(self, k_in):
+    def launched(self, k_in, polarized = False):
         #k_in: [[wavelength,kx,ky,kz,x,y,z,...]]
         if k_in.size>0:
-            self.store += [k_in]
+            if self.bins is None:
+                self.store += [k_in]
+            else:
+                self.accumulate(k_in)
         return np.empty((0, k_in.shape[1]))
 
+    def accumulate(self, k_in):
+        hv = Rays_convert_tool(input_format = 'k', output_format = 'hv').convert(k_in[:,:4])
+        coords = np.column_stack((k_in[:,7:9], hv[:,1:3], k_in[:,0]))
+        low, high = self.ranges.T
+        index = np.floor((coords-low)/(high-low)*self.bins).astype(int)
+        index[coords == high] -= 1
+        inside = np.all((index >= 0) & (index < self.bins), axis = 1)
+        flat = np.ravel_multi_index(index[inside].T, self.bins)
+        weight = k_in[inside,WEIGHT] if k_in.shape[1] > WEIGHT else None
+        self.histogram += np.bincount(flat, weights = weight, minlength = self.histogram.size).reshape(self.bins)
+
+    def edges(self):
+        #bin edges of x,y,h,v,wavelength
+        return [np.linspace(low, high, n+1) for (low, high), n in zip(self.ranges, self.bins)]
+
+    def reset(self):
+        self.store = []
+        if self.histogram is not None:
+            self.histogram = np.zeros(self.bins)
+
+    def merge(self, other):
+        #collect the rays received by a copy of this receiver (e.g. in a tracing worker)
+        self.store += other.store
+        if self.histogram is not None:
+            self.histogram += other.histogram
+
 # %%
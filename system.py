@@ -6,8 +6,233 @@ from shapely.geometry import Point,MultiPoint,LineString,MultiLineString,Polygon
 from shapely.affinity import translate
 from shapely.ops import unary_union
 import igraph as ig
+import os
+import time
+import pickle
+import hashlib
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor
 
 from elements import *
+class Layer_index:
+    def __init__(self, grid = (16,16), radius = 1E-3):
+        '''
+        bounding-box grid over the element polygons of one layer
+        each cell keeps the elements whose bounding box overlaps it, so a ray is only
+        tested against the polygons of its own cell
+        '''
+        self.grid = np.asarray(grid)
+        self.radius = radius
+        self.eids = []
+        self.polygons = []
+
+    def add(self, eid, polygon):
+        self.eids += [eid]
+        self.polygons += [polygon]
+        bbox = np.array([[p.vertices.min(axis = 0), p.vertices.max(axis = 0)] for p in self.polygons])
+        bbox += np.array([[-1],[1]])*self.radius                                #[element,min/max,xy]
+        self.lower = bbox[:,0].min(axis = 0)
+        self.cell = (bbox[:,1].max(axis = 0)-self.lower)/self.grid
+        self.cell[self.cell <= 0] = 1
+        cell_range = np.clip(np.floor((bbox-self.lower)/self.cell).astype(int), 0, self.grid-1)
+        self.table = np.zeros((*self.grid, len(self.eids)), dtype = bool)  #[cx,cy,element]
+        for i,((x0,y0),(x1,y1)) in enumerate(cell_range):
+            self.table[x0:x1+1,y0:y1+1,i] = True
+
+    def query(self, xy):
+        #return the eid hit by each point (-1: no element), the first added element has priority
+        owner = np.full(len(xy), -1)
+        cell = np.floor((xy-self.lower)/self.cell).astype(int)
+        inside = np.all((cell >= 0) & (cell <= self.grid), axis = 1)
+        cell = np.minimum(cell[inside], self.grid-1)
+        candidate = np.zeros((len(xy), len(self.eids)), dtype = bool)
+        candidate[inside] = self.table[cell[:,0], cell[:,1]]
+        for i, eid in enumerate(self.eids):
+            test = np.flatnonzero(candidate[:,i] & (owner == -1))
+            if test.size != 0:
+                hit = self.polygons[i].contains_points(xy[test], radius = self.radius)
+                owner[test[hit]] = eid
+        return owner
+
+class Ray_store:
+    #name: (columns in the traced rays, dtype), positions can be stored as float32
+    columns = {'wavelength': (slice(0,1), np.float64),
+               'k':          (slice(1,4), np.float64),
+               'start':      (slice(4,7), 'position'),
+               'end':        (slice(7,10), 'position'),
+               'eid':        (slice(10,11), np.int32),
+               'weight':     (slice(WEIGHT,WEIGHT+1), np.float64)}
+
+    def __init__(self, capacity = 1024, position_dtype = np.float64):
+        '''
+        columnar store of the traced ray segments, the capacity grows geometrically so appending
+        a hit batch is amortized O(batch)
+        '''
+        self.size = 0
+        self.position_dtype = np.dtype(position_dtype)
+        self.data = {name: np.empty((capacity, cols.stop-cols.start), 
+                                    dtype = self.position_dtype if dtype == 'position' else dtype)
+                     for name, (cols, dtype) in self.columns.items()}
+
+    def __len__(self):
+        return self.size
+
+    def __array__(self, dtype = None, copy = None):
+        return self.to_array() if dtype is None else self.to_array().astype(dtype)
+
+    def __getattr__(self, name):
+        #named column accessors: wavelength, k, start, end, eid, weight
+        if name in Ray_store.columns and 'data' in self.__dict__:
+            data = self.data[name][:self.size]
+            return data[:,0] if data.shape[1] == 1 else data
+        raise AttributeError(name)
+
+    @property
+    def capacity(self):
+        return len(self.data['k'])
+
+    def reserve(self, capacity):
+        if capacity > self.capacity:
+            capacity = max(capacity, 2*self.capacity)
+            for name in self.data:
+                data = np.empty((capacity, self.data[name].shape[1]), dtype = self.data[name].dtype)
+                data[:self.size] = self.data[name][:self.size]
+                self.data[name] = data
+
+    def append(self, rays):
+        #rays: [[wavelength,kx,ky,kz,x0,y0,z0,x,y,z,eid,weight]]
+        self.reserve(self.size+len(rays))
+        for name, (cols, _) in self.columns.items():
+            self.data[name][self.size:self.size+len(rays)] = rays[:,cols]
+        self.size += len(rays)
+
+    def extend(self, other):
+        self.reserve(self.size+len(other))
+        for name in self.data:
+            self.data[name][self.size:self.size+len(other)] = other.data[name][:len(other)]
+        self.size += len(other)
+
+    def to_array(self):
+        rays = np.empty((self.size, WEIGHT+1))
+        for name, (cols, _) in self.columns.items():
+            rays[:,cols] = self.data[name][:self.size]
+        return rays
+
+    @classmethod
+    def from_array(cls, rays, position_dtype = np.float64):
+        store = cls(max(len(rays),1), position_dtype)
+        store.append(rays)
+        return store
+
+    def unique(self):
+        rays, _ = unique_rays(self.to_array(), weight = WEIGHT)
+        return Ray_store.from_array(rays, self.position_dtype)
+
+    def trim(self):
+        #release the unused capacity (e.g. before pickling)
+        self.data = {name: self.data[name][:self.size].copy() for name in self.data}
+
+    def save(self, prefix):
+        #one .npy file per column: prefix_<column>.npy
+        for name in self.data:
+            np.save(f'{prefix}_{name}.npy', self.data[name][:self.size])
+
+    @classmethod
+    def load(cls, prefix, mmap_mode = 'r'):
+        #mmap_mode = 'r': the columns are memory-mapped and only read from disk when they are used
+        store = cls(0)
+        store.data = {name: np.load(f'{prefix}_{name}.npy', mmap_mode = mmap_mode) for name in cls.columns}
+        store.size = len(store.data['k'])
+        store.position_dtype = store.data['start'].dtype
+        return store
+
+def fingerprint(obj, digest):
+    #feed a canonical description of obj to the hash digest, 
+    #private attributes and the tracing state (launched source rays, receiver store and histogram) are skipped
+    if isinstance(obj, np.ndarray):
+        digest.update(repr((obj.dtype.str, obj.shape)).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        digest.update(b'{')
+        for key in sorted(obj, key = repr):
+            fingerprint(key, digest)
+            fingerprint(obj[key], digest)
+        digest.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b'[')
+        for item in obj:
+            fingerprint(item, digest)
+        digest.update(b']')
+    elif isinstance(obj, mpath.Path):
+        fingerprint((obj.vertices, obj.codes), digest)
+    elif hasattr(obj, '__dict__'):
+        digest.update(type(obj).__name__.encode())
+        fingerprint({name: value for name, value in vars(obj).items() 
+                     if not name.startswith('_') and name not in ('rays', 'store', 'histogram')}, digest)
+    else:
+        digest.update(repr(obj).encode())
+
+def csr(rows, n):
+    #compressed sparse rows of the entries with row index rows, return: indptr, entry order
+    order = np.argsort(rows, kind = 'stable')
+    return np.searchsorted(rows[order], np.arange(n+1)), order
+
+def csr_rows(indptr, rows):
+    #positions (in CSR order) of all entries of the given rows
+    start, length = indptr[rows], indptr[rows+1]-indptr[rows]
+    return np.repeat(start-np.cumsum(length)+length, length)+np.arange(length.sum())
+
+def reachable(edges, seeds, n):
+    #vertices reachable from the seeds along the edges [[from,to]], frontier search over a CSR adjacency
+    indptr, order = csr(edges[:,0], n)
+    targets = edges[order,1]
+    visited = np.zeros(n, dtype = bool)
+    visited[seeds] = True
+    frontier = np.unique(seeds)
+    while frontier.size:
+        frontier = targets[csr_rows(indptr, frontier)]
+        frontier = np.unique(frontier[~visited[frontier]])
+        visited[frontier] = True
+    return visited
+
+def save_graphs(prefix, graphs):
+    #the graphs concatenated: [vertex,edge] offsets, int32 edge lists (local vertex ids), eid, xyz, k attribute columns
+    np.save(f'{prefix}_vptr.npy', np.cumsum([0]+[G.vcount() for G in graphs]))
+    np.save(f'{prefix}_eptr.npy', np.cumsum([0]+[G.ecount() for G in graphs]))
+    np.save(f'{prefix}_edges.npy', np.vstack([np.zeros((0,2))]+[np.reshape(G.get_edgelist(),(-1,2)) for G in graphs]).astype(np.int32))
+    np.save(f'{prefix}_eid.npy', np.concatenate([[]]+[G.vs['eid'] for G in graphs]).astype(np.int32))
+    np.save(f'{prefix}_xyz.npy', np.vstack([np.zeros((0,3))]+[np.reshape(G.vs['xyz'],(-1,3)) for G in graphs]))
+    np.save(f'{prefix}_k.npy', np.vstack([np.zeros((0,3))]+[np.reshape(G.es['k'],(-1,3)) for G in graphs]))
+
+def load_graphs(prefix, wavelength, mmap_mode = 'r'):
+    #graphs written by save_graphs
+    vptr, eptr, edges, eid, xyz, k = [np.load(f'{prefix}_{name}.npy', mmap_mode = mmap_mode) 
+                                      for name in ('vptr','eptr','edges','eid','xyz','k')]
+    graphs = []
+    for j in range(len(vptr)-1):
+        DG = ig.Graph(n = int(vptr[j+1]-vptr[j]), edges = edges[eptr[j]:eptr[j+1]].tolist(), 
+                      directed = True, graph_attrs = {'wavelength': wavelength})
+        DG.vs['eid'] = eid[vptr[j]:vptr[j+1]].tolist()
+        DG.vs['xyz'] = xyz[vptr[j]:vptr[j+1]].tolist()
+        DG.es['k'] = k[eptr[j]:eptr[j+1]].tolist()
+        graphs += [DG]
+    return graphs
+
+def _init_worker(system):
+    #process pool initializer, the design is sent once to every worker
+    global _system
+    _system = system
+
+def _trace_path(krays, path_i, position_dtype, options):
+    #process pool job on the worker's copy of the design, the element state is private to the worker
+    system = _system
+    receivers = {eid: system.elements[eid][0] for eid in system.elements if isinstance(system.elements[eid][0], Receiver)}
+    for eid in receivers:
+        receivers[eid].reset()
+    status = {}
+    rays = system.trace_path(krays, path_i, position_dtype, status = status, **options)
+    return rays, receivers, status
+
 class System3D:
     def __init__(self, environment_material = Material('Air',[0,0,0,0,0,0]), 
                  boundary = [[-100,100],[-100,100],[-50,50]]):
@@ -15,6 +240,7 @@ class System3D:
         self.boundary = np.array(boundary)
         self.wavelengths = []
         self.layers = {}
+        self.layer_index = {}
         self.elements = {}
         self.sources = {}
         self.kpath = {}
@@ -40,6 +266,7 @@ class System3D:
             self.layers[z] += [self.eid]
         else:
             self.layers.update({z : [self.eid]})
+        self.layer_index.setdefault(z, Layer_index()).add(self.eid, polygon)
         self.eid += 1
 
     def add_path(self,config):
@@ -61,7 +288,6 @@ class System3D:
 
         #draw rays
         if hasattr(self,'rays'):
-            #[wavelength,kx,ky,kz,x0,y0,z0,x,y,z,eid]
             for wavelength in self.rays:
                 if wavelength >0.6:
                     colors = [1,0,0]
@@ -71,11 +297,8 @@ class System3D:
                     colors = [0,0,1]
                 else:
                     colors = [0,0,0]
-                rays = self.rays[wavelength]
-                if unique:
-                    rays = np.unique(rays,axis = 0)
-                if rays.shape[1]>3:
-                    rays= rays[:,4:10].reshape(-1,3).astype(np.float32)
+                rays = self.rays[wavelength].unique() if unique else self.rays[wavelength]
+                rays = np.hstack((rays.start, rays.end)).reshape(-1,3).astype(np.float32)
                 rays = vis.Buffer_rays(rays,colors = colors, width = 1)
                 view3d.add_obj(rays)
 
@@ -84,8 +307,9 @@ class System3D:
         for z in self.layers.keys():
             for ie in self.layers[z]:
                 element_type = type(self.elements[ie][0]).__name__
-                if element_type == 'Grating' or element_type == 'Receiver' or element_type == 'ColorFilter':
-                    colors = [1, 0, 1, 0.2] if element_type == 'Grating' else [0,0,0,0]
+                grating = isinstance(self.elements[ie][0], Grating)
+                if grating or element_type == 'Receiver' or element_type == 'ColorFilter':
+                    colors = [1, 0, 1, 0.2] if grating else [0,0,0,0]
                     vertices = np.column_stack((self.elements[ie][1].vertices, z*np.ones(len(self.elements[ie][1]))))
                     element = vis.polygon(vertices[:-1],colors = colors)
                     element = vis.Buffer_obj(*element,offset = True)
@@ -114,100 +338,320 @@ class System3D:
 
         view3d.draw()
 
-    def tracing(self, max_iter = 2):
+    def launch_sources(self):
+        source_krays =  np.vstack([self.sources[sid].launch() for sid in self.sources]) #[wavelength,kx,ky,kz,x,y,z]
+        source_krays = np.hstack((source_krays, np.zeros((source_krays.shape[0], 4)), #Expand 5 columns to place [x,y,z,eid,weight]
+                                  np.ones((source_krays.shape[0], 1))))
+        #[wavelength,kx,ky,kz,x0,y0,z0,x,y,z,eid,weight]
+        return source_krays
+
+    def _jobs(self):
+        #(wavelength, path) pairs in tracing order
+        kpath = list(self.kpath) if self.kpath else [-1]
+        return [(wavelength, path_i) for wavelength in dict.fromkeys(self.wavelengths) for path_i in kpath]
+
+    def tracing(self, max_iter = 2, workers = 1, position_dtype = np.float64, cache = None, **options):
+        '''
+        workers: number of processes, the design (self.design()) is sent once to every process and its
+                 (wavelength, path) jobs are traced on that copy of the elements
+                 1: trace in this process, None: use all cores
+        position_dtype: dtype of the start/end columns in the Ray_store (np.float32 halves their memory)
+        options: passed to trace_steps
+            threshold: rays whose weight falls below threshold (1 at the source) are dropped, only meaningful if the
+                       gratings give order efficiencies, with the default efficiency 1 the weights do not fall
+            bounce_limit: {'total': n, element type name: n}, maximum interactions of a ray
+            tolerance, window: early exit when the receivers converge
+            profile: per-iteration statistics of every job in self.stats
+            polarization: Jones vector [Ep,Es] of the source rays, polarized tracing through the Jones matrices
+        the termination of every (wavelength, path) job is reported in self.termination
+        cache: directory of the cached results, keyed by self.cache_key, an unchanged design is loaded 
+               (memory-mapped) instead of traced
+        '''
         self.rays = {}
+        self.termination = {}
+        self.stats = {}
         if not self.sources:
             print('This system have not source')
             return
-        source_krays =  np.vstack([self.sources[sid].launch() for sid in self.sources]) #[wavelength,kx,ky,kz,x,y,z]
-        source_krays = np.hstack((source_krays, np.zeros((source_krays.shape[0], 4)))) #Expand 4 columns to place [x,y,z,eid]
-        #[wavelength,kx,ky,kz,x0,y0,z0,x,y,z,eid]
-        for wavelength in self.wavelengths:
-            self.rays[wavelength] = []
-            kpath = self.kpath if self.kpath else [-1]
-            for path_i in kpath:
-                krays = source_krays[source_krays[:,0] == wavelength]
-                if path_i != -1:
-                    for eid in kpath[path_i]:
-                        self.elements[eid][0].diffract_order = kpath[path_i][eid]
-                for _ in range(max_iter):
-                    #Rays propagate to next surface
-                    index = np.sqrt(np.sum(krays[:,1:4]**2,axis = 1))
-                    direction_cosine = krays[:,1:4]/index[:,np.newaxis]
-                    delta_z = np.asarray(list(self.layers.keys()))-krays[:,6:7]
-                    step = delta_z/direction_cosine[:,-1:]
-                    step = np.min(np.where(step > 0, step, np.inf), axis=1)
-                    alive = np.isfinite(step)
-                    krays = krays[alive]
-                    step = direction_cosine[alive]*step[alive,np.newaxis]
-                    krays[:,7:10] = np.round(krays[:,4:7] + step, 4)
-
-                    #Rays interact with elements
-                    next_krays = []
-                    z_list = set(krays[:,-2])
-                    for zl in z_list:
-                        hitting = krays[:,-2] == zl
-                        hit_rays = krays[hitting]
-                        krays = krays[~hitting]
-
-                        for eid in self.layers[zl]:
-                            hit = self.elements[eid][1].contains_points(hit_rays[:,7:9],radius=1E-3)
-                            if np.any(hit):
-                                hit_rays[hit,-1] = eid
-                                self.rays[wavelength] += [hit_rays[hit]] 
-                                next_krays += [self.elements[eid][0].launched(hit_rays[hit])]
-                                hit_rays = hit_rays[~hit]
-                        if hit_rays.size != 0:
-                            next_krays += [hit_rays]
-
-                    if len(next_krays) != 0:
-                        krays = np.vstack(next_krays)
-                        krays[:,4:7] = krays[:,7:10]
-                    else:
-                        break
-            if self.rays[wavelength]:
-                self.rays[wavelength] = np.vstack(self.rays[wavelength])
-
-    def generate_graph(self,type = 'graph',end_eid = None):
+        if cache is not None:
+            self.key = self.cache_key(max_iter = max_iter, position_dtype = np.dtype(position_dtype).str, **options)
+            path = os.path.join(cache, self.key)
+            #save() writes meta.pkl last, a directory without it is an interrupted save
+            if os.path.exists(os.path.join(path, 'meta.pkl')):
+                self.load(path)
+                return
+        elif hasattr(self,'key'):
+            #the key belongs to an earlier tracing, generate_graph must not use its cache
+            del self.key
+        source_krays = self.launch_sources()
+        jobs = self._jobs()
+        options['max_iter'] = max_iter
+        if workers == 1:
+            results = []
+            for wavelength, path_i in jobs:
+                self.termination[wavelength, path_i] = {}
+                results += [self.trace_path(source_krays[source_krays[:,0] == wavelength], path_i, position_dtype,
+                                            status = self.termination[wavelength, path_i], **options)]
+        else:
+            with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (self.design(),)) as pool:
+                futures = [pool.submit(_trace_path, source_krays[source_krays[:,0] == wavelength], path_i, position_dtype, options) 
+                           for wavelength, path_i in jobs]
+                results = []
+                for job, future in zip(jobs, futures):
+                    rays, receivers, self.termination[job] = future.result()
+                    for eid in receivers:
+                        self.elements[eid][0].merge(receivers[eid])
+                    results += [rays]
+            if jobs[-1][1] != -1:
+                for eid in self.kpath[jobs[-1][1]]:
+                    self.elements[eid][0].diffract_order = self.kpath[jobs[-1][1]][eid]
+
+        for job in self.termination:
+            if 'stats' in self.termination[job]:
+                self.stats[job] = self.termination[job].pop('stats')
+        for (wavelength, _), rays in zip(jobs, results):
+            if wavelength in self.rays:
+                self.rays[wavelength].extend(rays)
+            else:
+                self.rays[wavelength] = rays
+        if cache is not None:
+            self.save(path, items = ('rays',))
+
+    def design(self):
+        #copy of the system without the tracing results (rays, graphs, receiver hits), the elements are copied
+        design = copy(self)
+        for name in ('rays', 'graph', 'linegraph', 'launch_bits', 'interactions', 'termination', 'stats'):
+            design.__dict__.pop(name, None)
+        design.elements = {eid: (copy(element), polygon) for eid, (element, polygon) in self.elements.items()}
+        for element, _ in design.elements.values():
+            if isinstance(element, Receiver):
+                element.reset()
+        return design
+
+    def trace_iter(self, max_iter = 2, **options):
+        '''
+        streaming mode of tracing, the segments are handed over as they are produced and not kept in self.rays
+        the receivers do not store their hits either (they are in the yielded hits), so the memory is bounded by 
+        the rays of one iteration, receivers in histogram mode still accumulate
+        options: see tracing
+        yield: wavelength, path index, {eid: hit segments} of every iteration
+        '''
+        self.termination = {}
+        self.stats = {}
+        if not self.sources:
+            print('This system have not source')
+            return
+        stores = {eid: len(self.elements[eid][0].store) for eid in self.elements if isinstance(self.elements[eid][0], Receiver)}
+        source_krays = self.launch_sources()
+        for job in self._jobs():
+            self.termination[job] = {}
+            for hits in self.trace_steps(source_krays[source_krays[:,0] == job[0]], job[1], max_iter, 
+                                         status = self.termination[job], **options):
+                for eid in stores:
+                    del self.elements[eid][0].store[stores[eid]:]
+                yield *job, hits
+            if 'stats' in self.termination[job]:
+                self.stats[job] = self.termination[job].pop('stats')
+
+    def trace_path(self, krays, path_i = -1, position_dtype = np.float64, **options):
+        #trace the rays of one wavelength along one k-path, return the hit segments in a Ray_store
+        rays = Ray_store(position_dtype = position_dtype)
+        for hits in self.trace_steps(krays, path_i, **options):
+            for eid in hits:
+                rays.append(hits[eid])
+        rays.trim()
+        return rays
+
+    def trace_steps(self, krays, path_i = -1, max_iter = 2, threshold = 0, bounce_limit = {}, 
+                    tolerance = 0, window = 10, profile = False, polarization = None, prune = 64, status = None):
+        '''
+        trace the rays of one wavelength along one k-path, yield the hit segments {eid: rays} of every iteration
+        the hit segments carry the bounce counters [...,weight,total,<element type>...] behind the weight column
+        polarization: Jones vector [Ep,Es] of the launched rays in their plane of incidence, the rays then carry the
+            polarization columns [...,weight,Ep_re,Ep_im,Es_re,Es_im,sx,sy,sz,total,...] and the elements apply 
+            their Jones matrices (the Ray_store keeps up to the weight column, the receivers store everything)
+        bounce_limit: {'total': n, element type name: n}, a ray is dropped after more than n interactions
+        tolerance, window: stop when the receivers got less than tolerance of their total weight in the last window iterations
+        prune: k-space cells per axis of the order tables (Grating.prune) built for the path, the gratings then skip
+            the orders that are evanescent for the rays, 0: every order of diffract_order is evaluated
+        profile: record per-iteration statistics in status['stats'] as a dict of arrays
+            alive: live rays, hits/produced: [iteration,eid] rays hitting/launched by every element of stats['eid'],
+            propagate/hit_test/launched/unique_rays/merge: time [s] of every phase (unique_rays is part of launched)
+        status: dict filled with the termination reason ('max_iter', 'escaped', 'converged') and the counts
+        '''
+        status = {} if status is None else status
+        status.update({'reason': 'max_iter', 'iterations': 0, 'bounce_dropped': 0, 'power_dropped': 0})
+        types = sorted({type(self.elements[eid][0]).__name__ for eid in self.elements})
+        polarized = polarization is not None
+        base = WEIGHT+1+(POLARIZATION if polarized else 0)
+        counter = {name: base+1+i for i, name in enumerate(types)} | {'total': base}
+        limit = np.array([[counter[name], bounce_limit[name]] for name in bounce_limit]).reshape((-1,2))
+        receivers = [eid for eid in self.elements if isinstance(self.elements[eid][0], Receiver)]
+        received = []
+        if profile:
+            column = {eid: i for i, eid in enumerate(self.elements)}
+            stats = {name: [] for name in ['alive','hits','produced','propagate','hit_test','launched','unique_rays','merge']}
+            status['stats'] = stats
+
+        krays = np.hstack((krays[:,:WEIGHT+1], np.zeros((len(krays), base-WEIGHT-1+len(counter)))))
+        if polarized:
+            jones = np.asarray(polarization, dtype = complex)/np.linalg.norm(polarization)
+            krays[:,JONES:JONES+4] = [jones[0].real, jones[0].imag, jones[1].real, jones[1].imag]
+            krays[:,JONES+4:JONES+7] = s_vector(krays[:,1:4])
+        layer_z = np.sort(list(self.layers.keys()))
+        #index of the next layer along kz, out of [0,len(layer_z)) means the ray leaves the system
+        lid = np.where(krays[:,3]>0, np.searchsorted(layer_z, krays[:,6], side = 'right'),
+                                     np.searchsorted(layer_z, krays[:,6], side = 'left')-1)
+        if path_i != -1:
+            for eid in self.kpath[path_i]:
+                self.elements[eid][0].diffract_order = self.kpath[path_i][eid]
+        if prune:
+            for eid in self.elements:
+                if isinstance(self.elements[eid][0], Grating):
+                    for wavelength in np.unique(krays[:,0]):
+                        self.elements[eid][0].prune(wavelength, prune)
+        for i in range(max_iter):
+            status['iterations'] = i+1
+            if profile:
+                t0, t_hit, t_launched, t_unique = time.perf_counter(), 0, 0, TIMER['unique_rays']
+                hit_count, produced = np.zeros(len(column), dtype = int), np.zeros(len(column), dtype = int)
+            #Rays propagate to next surface
+            alive = (lid >= 0) & (lid < len(layer_z)) & (krays[:,3] != 0)
+            krays, lid = krays[alive], lid[alive]
+            index = np.sqrt(np.sum(krays[:,1:4]**2,axis = 1))
+            direction_cosine = krays[:,1:4]/index[:,np.newaxis]
+            step = (layer_z[lid]-krays[:,6])/direction_cosine[:,-1]
+            krays[:,7:10] = np.round(krays[:,4:7] + direction_cosine*step[:,np.newaxis], 4)
+            if profile:
+                stats['alive'] += [len(krays)]
+                stats['propagate'] += [time.perf_counter()-t0]
+
+            #Rays interact with elements
+            hits = {}
+            next_krays, next_lid = [], []
+            for li in np.unique(lid):
+                zl = layer_z[li]
+                hit_rays = krays[lid == li]
+                if profile:
+                    t0 = time.perf_counter()
+                owner = self.layer_index[zl].query(hit_rays[:,7:9])
+                if profile:
+                    t_hit += time.perf_counter()-t0
+                for eid in self.layers[zl]:
+                    hit = owner == eid
+                    if np.any(hit):
+                        hit_rays[hit,10] = eid
+                        hits[eid] = hit_rays[hit]
+                        if profile:
+                            t0 = time.perf_counter()
+                        next_krays += [self.elements[eid][0].launched(hits[eid], polarized)]
+                        if profile:
+                            t_launched += time.perf_counter()-t0
+                            hit_count[column[eid]], produced[column[eid]] = len(hits[eid]), len(next_krays[-1])
+                        next_krays[-1][:,[counter['total'], counter[type(self.elements[eid][0]).__name__]]] += 1
+                        next_lid += [np.full(len(next_krays[-1]), li)]
+                if np.any(owner == -1):
+                    next_krays += [hit_rays[owner == -1]]
+                    next_lid += [np.full(len(next_krays[-1]), li)]
+            if profile:
+                stats['hit_test'] += [t_hit]
+                stats['launched'] += [t_launched]
+                stats['unique_rays'] += [TIMER['unique_rays']-t_unique]
+                stats['hits'] += [hit_count]
+                stats['produced'] += [produced]
+                t0 = time.perf_counter()
+            if hits:
+                yield hits
+                if profile:
+                    t0 = time.perf_counter()
+
+            if len(next_krays) == 0:
+                status['reason'] = 'escaped'
+                break
+            krays = np.vstack(next_krays)
+            krays[:,4:7] = krays[:,7:10]
+            lid = np.concatenate(next_lid) + np.where(krays[:,3]>0,1,-1)
+            if threshold > 0:
+                bright = krays[:,WEIGHT] >= threshold
+                status['power_dropped'] += np.count_nonzero(~bright)
+                krays, lid = krays[bright], lid[bright]
+            if len(limit) != 0:
+                budget = np.all(krays[:,limit[:,0]] <= limit[:,1], axis = 1)
+                status['bounce_dropped'] += np.count_nonzero(~budget)
+                krays, lid = krays[budget], lid[budget]
+            if profile:
+                stats['merge'] += [time.perf_counter()-t0]
+            if tolerance > 0:
+                received += [sum(np.sum(hits[eid][:,WEIGHT]) for eid in receivers if eid in hits)]
+                if i+1 >= window and sum(received[-window:]) < tolerance*sum(received):
+                    status['reason'] = 'converged'
+                    break
+        if profile:
+            stats['merge'] += [0.0]*(len(stats['alive'])-len(stats['merge']))
+            for name in stats:
+                stats[name] = np.asarray(stats[name]).reshape((-1,len(column))) if name in ['hits','produced'] else np.asarray(stats[name])
+            stats['iteration'] = np.arange(len(stats['alive']))
+            stats['eid'] = np.asarray(list(column))
+
+    def generate_graph(self,type = 'graph',end_eid = None, cache = None, subgraphs = True):
+        '''
+        cache: directory of the cached results, used with the key of the cached tracing (self.key),
+               the graph is stored with the merged rays it was built from
+        subgraphs: build the igraph subgraph of every launch edge in self.graph, False: only the launch labels
+                   are kept (self.launch_bits, read by launch_mask) and the cache is not used
+        '''
         if not hasattr(self,'rays'):
             print('Without rays in the system')
             return
         
         self.graph = {}
         self.linegraph = {}
-        source_krays =  np.vstack([self.sources[sid].launch() for sid in self.sources]) #[wavelength,kx,ky,kz,x,y,z]
-        for wavelength in self.wavelengths:
-            self.graph[wavelength] = []
-            #[wavelength,kx,ky,kz,x0,y0,z0,x,y,z,eid]
-            self.rays[wavelength] =  np.unique(self.rays[wavelength],axis = 0)
-            srays = source_krays[source_krays[:,0] == wavelength]
-            vertices = np.unique(self.rays[wavelength][:,7:],axis = 0)
-            nodes_name = [f'({x:.4f},{y:.4f},{z:.4f})' for x,y,z in vertices[:,:-1]]
-            nodes_eid = vertices[:,-1].tolist()
-            nodes_xyz = vertices[:,:-1].tolist()
-            edges = [(f'({x0:.4f},{y0:.4f},{z0:.4f})' , f'({x:.4f},{y:.4f},{z:.4f})') for x0,y0,z0,x,y,z in self.rays[wavelength][:,4:10]]
-            edges_k = self.rays[wavelength][:,1:4].tolist()
-
-            DG = ig.Graph(directed=True ,graph_attrs = {'wavelength': wavelength})
-            DG.add_vertices([f'({x:.4f},{y:.4f},{z:.4f})' for x,y,z in srays[:,4:7]],
-                            {'eid':0,
-                             'xyz': srays[:,4:7].tolist()})
-            
-            DG.add_vertices(nodes_name,{'eid':nodes_eid,'xyz':nodes_xyz})
-            DG.add_edges(edges,{'k': edges_k})
-            # simply graph: Remove paths that don't reach the final element(receiver).
-            if end_eid is None:
-                end_eid = self.eid-1
-            valid_nodes = [DG.subcomponent(vs, mode='in') for vs in DG.vs.select(eid=end_eid).indices]
-            DG = DG.induced_subgraph(set.union(*map(set,valid_nodes))) if valid_nodes else ig.Graph(directed=True)
-            #To separate independent graph
-            DG_list = [DG.subgraph([vs.index] + DG.subcomponent(DG.es[i].target,mode='out'))
-                       for vs in DG.vs if vs['eid'] == 0 for i in DG.incident(vs.index, mode='out')]
-            for DG in DG_list:
-                scc = DG.connected_components(mode="strong")
-                back_edge = [tuple(edge[::-1]) for edge in scc if len(edge) == 2]
+        self.launch_bits = {}
+        if end_eid is None:
+            end_eid = self.eid-1
+        path = os.path.join(cache, self.key, f'graph_{end_eid}') if cache is not None and hasattr(self,'key') and subgraphs else None
+        if path is not None and os.path.exists(os.path.join(path, 'meta.pkl')):
+            self.load(path)
+        else:
+            source_krays =  np.vstack([self.sources[sid].launch() for sid in self.sources]) #[wavelength,kx,ky,kz,x,y,z]
+            for wavelength in self.wavelengths:
+                self.graph[wavelength] = []
+                rays = self.rays[wavelength] = self.rays[wavelength].unique()
+                srays = source_krays[source_krays[:,0] == wavelength]
+                #vertices are the distinct positions keyed by their quantized coordinates, 
+                #numbered sources first and then in (x,y,z) order
+                xyz = np.vstack((srays[:,4:7], rays.end, rays.start))
+                eid = np.concatenate((np.zeros(len(srays), dtype = int), rays.eid, np.full(len(rays), -1)))
+                first, vid, _ = group_rows(xyz, decimals = 4)
+                key = np.round(xyz[first]*1E4).astype(np.int64)
+                order = np.lexsort((key[:,2], key[:,1], key[:,0]))
+                order = np.concatenate((np.flatnonzero(first < len(srays)), order[first[order] >= len(srays)]))
+                first, vid = first[order], np.argsort(order)[vid]
+                edges = np.column_stack((vid[len(srays)+len(rays):], vid[len(srays):len(srays)+len(rays)]))
+
+                DG = ig.Graph(n = len(first), edges = edges, directed = True, graph_attrs = {'wavelength': wavelength})
+                DG.vs['eid'] = eid[first].tolist()
+                DG.vs['xyz'] = np.round(xyz[first].astype(float), 4).tolist()
+                DG.es['k'] = rays.k.tolist()
+                # simply graph: Remove paths that don't reach the final element(receiver).
+                receivers = np.flatnonzero(eid[first] == end_eid)
+                if receivers.size == 0:
+                    continue
+                DG = DG.induced_subgraph(np.flatnonzero(reachable(edges[:,::-1], receivers, DG.vcount())))
+                #To separate independent graph
+                launch = [i for vs in DG.vs.select(eid=0).indices for i in DG.incident(vs, mode='out')]
+                scc = np.asarray(DG.connected_components(mode="strong").membership, dtype = int)
+                launch_bits = System3D.launch_labels(DG, launch, scc)
+                edges = np.asarray(DG.get_edgelist()).reshape((-1,2))
+                pair = np.bincount(scc, minlength = DG.vcount())[scc] == 2
+                back_edge = np.flatnonzero(pair[edges[:,0]] & (scc[edges[:,0]] == scc[edges[:,1]]) & (edges[:,0] > edges[:,1]))
                 DG.delete_edges(back_edge)
-                self.graph[wavelength] += [DG]
+                self.launch_bits[wavelength] = (DG, launch_bits, edges[launch,0])
+                if subgraphs:
+                    self.graph[wavelength] = [DG.induced_subgraph(np.flatnonzero(self.launch_mask(wavelength, l)[1]))
+                                              for l in range(len(launch))]
+            if path is not None:
+                self.save(path)
         if type == 'linegraph':
             for wavelength in self.wavelengths:
                 self.linegraph[wavelength] = []
@@ -229,11 +673,134 @@ class System3D:
                         LG.es.set_attribute_values(*key_values)
                     self.linegraph[wavelength] += [LG]
             
-    def draw_graph(self,graph_index,edge_width = 1, node_size = 80, arrow = False, show_index = False, label_size = 12):
+    def cache_key(self, **params):
+        #content hash of the design (sources, elements, layers, kpath) and the tracing parameters
+        #the diffraction orders of the elements on a kpath and the tables derived from them (private attributes,
+        #e.g. the order tables of Grating) are set by the path while tracing
+        on_path = {eid for path in self.kpath.values() for eid in path}
+        elements = {eid: (type(element).__name__, {name: value for name, value in vars(element).items() 
+                                                   if name != 'diffract_order' and not name.startswith('_')}, polygon)
+                    if eid in on_path else (element, polygon) for eid, (element, polygon) in self.elements.items()}
+        digest = hashlib.sha1()
+        fingerprint((self.index, self.boundary, self.sources, elements, self.layers, self.kpath, params), digest)
+        return digest.hexdigest()
+
+    def save(self, directory, items = ('rays', 'graph')):
+        '''
+        rays: one .npy file per Ray_store column and per receiver, termination and stats in meta.pkl
+        graph: the subgraphs of every wavelength concatenated, [vertex,edge] offsets, int32 edge lists 
+               (local vertex ids) and the eid, xyz, k attribute columns (save_graphs), and the launch labels 
+               (launch_bits) with their simplified graph
+        '''
+        os.makedirs(directory, exist_ok = True)
+        meta = {}
+        if 'rays' in items and hasattr(self,'rays'):
+            meta['rays'] = list(self.rays)
+            for i, wavelength in enumerate(self.rays):
+                self.rays[wavelength].save(os.path.join(directory, f'rays_{i}'))
+            meta['receivers'] = [eid for eid in self.elements if isinstance(self.elements[eid][0], Receiver)]
+            for eid in meta['receivers']:
+                store = self.elements[eid][0].store
+                np.save(os.path.join(directory, f'receiver_{eid}.npy'), 
+                        np.vstack(store) if store else np.empty((0, WEIGHT+1)))
+                if self.elements[eid][0].histogram is not None:
+                    np.save(os.path.join(directory, f'receiver_{eid}_histogram.npy'), self.elements[eid][0].histogram)
+            meta['termination'], meta['stats'] = self.termination, self.stats
+        if 'graph' in items and hasattr(self,'graph'):
+            meta['graph'] = list(self.graph)
+            for i, wavelength in enumerate(self.graph):
+                save_graphs(os.path.join(directory, f'graph_{i}'), self.graph[wavelength])
+            #the launch labels with the simplified graph they refer to (launch_mask)
+            meta['launch'] = list(getattr(self, 'launch_bits', {}))
+            for i, wavelength in enumerate(meta['launch']):
+                DG, bits, source = self.launch_bits[wavelength]
+                prefix = os.path.join(directory, f'launch_{i}')
+                save_graphs(prefix, [DG])
+                np.save(f'{prefix}_bits.npy', bits)
+                np.save(f'{prefix}_source.npy', source)
+        with open(os.path.join(directory, 'meta.pkl'), 'wb') as file:
+            pickle.dump(meta, file)
+
+    def load(self, directory, mmap_mode = 'r'):
+        #load what save() wrote, the ray columns are memory-mapped with mmap_mode = 'r'
+        with open(os.path.join(directory, 'meta.pkl'), 'rb') as file:
+            meta = pickle.load(file)
+        if 'rays' in meta:
+            self.rays = {wavelength: Ray_store.load(os.path.join(directory, f'rays_{i}'), mmap_mode) 
+                         for i, wavelength in enumerate(meta['rays'])}
+            for eid in meta['receivers']:
+                store = np.load(os.path.join(directory, f'receiver_{eid}.npy'))
+                self.elements[eid][0].store = [store] if len(store) else []
+                if os.path.exists(os.path.join(directory, f'receiver_{eid}_histogram.npy')):
+                    self.elements[eid][0].histogram = np.load(os.path.join(directory, f'receiver_{eid}_histogram.npy'))
+            self.termination, self.stats = meta['termination'], meta['stats']
+            #as after tracing, the elements keep the diffraction orders of the last path
+            if self.kpath:
+                for eid in self.kpath[list(self.kpath)[-1]]:
+                    self.elements[eid][0].diffract_order = self.kpath[list(self.kpath)[-1]][eid]
+        if 'graph' in meta:
+            self.graph = {}
+            for i, wavelength in enumerate(meta['graph']):
+                self.graph[wavelength] = load_graphs(os.path.join(directory, f'graph_{i}'), wavelength, mmap_mode)
+            self.launch_bits = {}
+            for i, wavelength in enumerate(meta.get('launch', [])):
+                prefix = os.path.join(directory, f'launch_{i}')
+                self.launch_bits[wavelength] = (load_graphs(prefix, wavelength, mmap_mode)[0], 
+                                                np.load(f'{prefix}_bits.npy'), np.load(f'{prefix}_source.npy'))
+
+    @staticmethod
+    def launch_labels(DG, launch, scc = None):
+        '''
+        label the vertices with the launch edges they are reachable from, in one sweep over the 
+        condensation of the graph (strongly connected components) in topological order
+        launch: edge ids of the launch edges
+        scc: strongly connected component of every vertex (membership), computed if None
+        return: bits [vertex,word], bit l is set if the vertex is reachable from the target of launch[l]
+        '''
+        edges = np.asarray(DG.get_edgelist()).reshape((-1,2))
+        if scc is None:
+            scc = np.asarray(DG.connected_components(mode="strong").membership, dtype = int)
+        n = scc.max()+1 if scc.size else 0
+        bits = np.zeros((n, (len(launch)+63)//64), dtype = np.uint64)
+        for l, i in enumerate(launch):
+            bits[scc[edges[i,1]], l >> 6] |= np.uint64(1) << np.uint64(l & 63)
+        cu, cv = scc[edges[:,0]], scc[edges[:,1]]
+        cu, cv = cu[cu != cv], cv[cu != cv]
+        indptr, order = csr(cu, n)
+        cv = cv[order]
+        indegree = np.bincount(cv, minlength = n)
+        frontier = np.flatnonzero(indegree == 0)
+        while frontier.size:
+            out = csr_rows(indptr, frontier)
+            source = np.repeat(frontier, np.diff(indptr)[frontier])
+            np.bitwise_or.at(bits, cv[out], bits[source])
+            indegree -= np.bincount(cv[out], minlength = n)
+            frontier = np.unique(cv[out])
+            frontier = frontier[indegree[frontier] == 0]
+        return bits[scc]
+
+    def launch_mask(self, wavelength, graph_index):
+        '''
+        vertices of the subgraph self.graph[wavelength][graph_index] without building it (generate_graph)
+        return: simplified graph DG of the wavelength, [vertex] bool mask of the subgraph in DG
+        '''
+        DG, bits, source = self.launch_bits[wavelength]
+        member = ((bits[:,graph_index >> 6] >> np.uint64(graph_index & 63)) & np.uint64(1)).astype(bool)
+        member[source[graph_index]] = True
+        return DG, member
+
+    def draw_graph(self,graph_index,edge_width = 1, node_size = 80, arrow = False, show_index = False, label_size = 12,
+                   wavelength = None, max_edges = None, decimals = 3):
+        '''
+        the edges are drawn in one LineCollection (arrow = True: one quiver call)
+        max_edges: level of detail, edges with the same projected (x,y) segment at decimals are drawn once and 
+                   if there are still more than max_edges, every n-th edge is kept
+        '''
         import matplotlib.patches as patches
+        from matplotlib.collections import LineCollection
         if not hasattr(self,'graph'):
             return
-        DG = self.graph[0.525][graph_index]
+        DG = self.graph[list(self.graph)[0] if wavelength is None else wavelength][graph_index]
         label = [str(i) for i in DG.vs.indices]
         eid = DG.vs['eid']
         coords = np.asarray(DG.vs['xyz'])[:,:2]
@@ -252,16 +819,16 @@ class System3D:
                 ax.add_patch(patch)
 
         # draw edges
-        for edge in DG.es:
-            src, tgt = edge.tuple
-            if arrow:
-                ax.annotate("", xy=coords[tgt], xytext=coords[src],
-                            arrowprops=dict(arrowstyle="->", color='black', lw=1.5, alpha=0.7),
-                            fontsize=label_size)
-            else:
-                ax.plot([coords[src,0], coords[tgt,0]],[coords[src,1], coords[tgt,1]],
-                        color='black', linewidth=edge_width)
-
+        segments = coords[np.reshape(DG.get_edgelist(), (-1,2))]  #[edge,(src,tgt),(x,y)]
+        if max_edges is not None and len(segments) > max_edges:
+            first, _, _ = group_rows(segments.reshape((-1,4)), decimals)
+            segments = segments[np.sort(first)]
+            segments = segments[::-(-len(segments)//max_edges)]
+        if arrow:
+            ax.quiver(segments[:,0,0], segments[:,0,1], *(segments[:,1]-segments[:,0]).T,
+                      angles='xy', scale_units='xy', scale=1, color='black', alpha=0.7, width=0.002*edge_width)
+        else:
+            ax.add_collection(LineCollection(segments, colors='black', linewidths=edge_width))
 
         # draw nodes
         ax.scatter(coords[:,0],coords[:,1],
@@ -277,32 +844,140 @@ class System3D:
         ax.set_aspect('equal')
         plt.show()
 
-    def interaction_info(self):
-        if hasattr(self,'linegraph') and not hasattr(self,'interaction'):
-            wl,kix,kiy,kiz,kox,koy,koz,eid = [],[],[],[],[],[],[],[]
-            for wavelength in self.wavelengths:
-                for graph in self.linegraph[wavelength]:
-                    wl += graph.es.get_attribute_values('wavelength')
-                    kix += graph.es.get_attribute_values('kin_x')
-                    kiy += graph.es.get_attribute_values('kin_y')
-                    kiz += graph.es.get_attribute_values('kin_z')
-                    kox += graph.es.get_attribute_values('kout_x')
-                    koy += graph.es.get_attribute_values('kout_y')
-                    koz += graph.es.get_attribute_values('kout_z')
-                    eid += graph.es.get_attribute_values('eid')
-            interactions = np.unique(np.vstack((wl,kix,kiy,kiz,kox,koy,koz,eid)),axis = 1).T
-            
-            self.interactions = {}
-            for eid in self.elements:
-                if type(self.elements[eid][0]) == Grating:
-                    interaction = interactions[interactions[:,7]==eid]
-                    diff_order = self.elements[eid][0].diffract_order
-                    diff_order = np.unique(np.vstack(list(diff_order.values()))[:,1:],axis = 0)
-                    dkxy = (interaction[:,4:6]-interaction[:,1:3])/interaction[:,:1]
-                    diection = np.vstack((np.where(interaction[:,3]>=0,1,-1),np.where(interaction[:,6]>=0,1,-1))).T
-                    order_gv = diff_order[:,-2:] @ self.elements[eid][0].g_vectors
-                    order_i = np.argmin(np.sum(np.abs(dkxy[:,np.newaxis]-order_gv),axis = 2),axis = 1)
-                    self.interactions[eid] = np.hstack((interaction,diection,diff_order[order_i]))
+    def interaction_info(self, decimals = 4, tolerance = 1E-4):
+        '''
+        pair the incoming and outgoing segments at every grating hit of the traced rays
+        (end point of the incoming ray = start point of the outgoing ray, compared at decimals)
+        pairs that no diffraction order of the grating explains are dropped, the orders of every kpath are used 
+        since the rays of all the paths are traced (path_orders)
+        self.interactions: {eid:[[wavelength,kin_x,kin_y,kin_z,kout_x,kout_y,kout_z,eid,in_direct,out_direct,m,n]]}
+        '''
+        if not hasattr(self,'rays'):
+            print('Please run tracing first')
+            return
+        gratings = [eid for eid in self.elements if isinstance(self.elements[eid][0], Grating)]
+        tables = {eid: [] for eid in gratings}
+        for wavelength in self.rays:
+            rays = self.rays[wavelength]
+            _, gid, counts = group_rows(np.vstack((rays.end, rays.start)), decimals)
+            gin, gout = gid[:len(rays)], gid[len(rays):]
+            indptr, order = csr(gout, len(counts))
+            k, eids = rays.k, rays.eid
+            for eid in gratings:
+                grating = self.elements[eid][0]
+                hit = np.flatnonzero(eids == eid)
+                i_in = np.repeat(hit, np.diff(indptr)[gin[hit]])
+                i_out = order[csr_rows(indptr, gin[hit])]
+                direct = np.column_stack((np.where(k[i_in,2]>=0,1,-1), np.where(k[i_out,2]>=0,1,-1)))
+                dkxy = (k[i_out,:2]-k[i_in,:2])/wavelength
+                for in_direct, diff_order in self.path_orders(eid).items():
+                    pair = np.flatnonzero(direct[:,0] == in_direct)
+                    diff_order = np.unique(diff_order[:,:3], axis = 0)
+                    order_gv = diff_order[:,1:3] @ grating.g_vectors
+                    residual = np.sum(np.abs(dkxy[pair,np.newaxis]-order_gv),axis = 2)
+                    residual[direct[pair,1:2] != diff_order[:,0]] = np.inf
+                    order_i = np.argmin(residual,axis = 1) if residual.size else np.zeros(0, dtype = int)
+                    match = residual[np.arange(len(pair)),order_i] < tolerance
+                    pair, order_i = pair[match], order_i[match]
+                    tables[eid] += [np.column_stack((np.full(len(pair),wavelength), k[i_in[pair]], k[i_out[pair]],
+                                                     np.full(len(pair),eid), direct[pair], diff_order[order_i,1:3]))]
+        self.interactions = {eid: np.unique(np.round(np.vstack(tables[eid]),6),axis = 0) if tables[eid] else np.empty((0,12))
+                             for eid in gratings}
+        return self.interactions
+
+    def path_orders(self, eid):
+        #{in-direct: [[out-direct,m_order,n_order,efficiency]]} of a grating over its diffract_order and every kpath
+        orders = {}
+        for diffract_order in [self.elements[eid][0].diffract_order]+[path[eid] for path in self.kpath.values() if eid in path]:
+            for in_direct, diff_order in diffract_order.items():
+                if len(diff_order):
+                    diff_order = np.asarray(diff_order, dtype = float).reshape((len(diff_order), -1))
+                    diff_order = np.column_stack((diff_order[:,:3], diff_order[:,3] if diff_order.shape[1] > 3 else np.ones(len(diff_order))))
+                    orders[in_direct] = np.vstack((orders.get(in_direct, np.empty((0,4))), diff_order))
+        return {in_direct: np.unique(diff_order, axis = 0) for in_direct, diff_order in orders.items()}
+
+    def transfer_matrix(self, wavelength, graph_index, end_eid = None, tolerance = 1E-4):
+        '''
+        sparse transfer of the ray power along one per-source graph, the power of an outgoing ray (edge) is the
+        sum over the incoming rays of the same vertex of (power in)*(efficiency of the interaction in -> out)
+        the interaction of a pair is the order (m,n) with k_out_xy = k_in_xy + wavelength*(m*gv1+n*gv2), 
+        elements without g_vectors only pass the order (0,0), pairs no order explains are dropped
+        return: {'keys':     [[eid,in_direct,out_direct,m,n]] of the interactions,
+                 'default':  efficiency of every key (diffract_order efficiency of gratings, else 1),
+                 'pair_in', 'pair_key': incoming edge and key of every pair,
+                 'scatter':  sparse [edge,pair], sums the pairs into their outgoing edge,
+                 'launch':   edges leaving the source vertices (power 1),
+                 'collect':  sparse [receiver vertex,edge], sums the edges ending on the receiver,
+                 'receivers': vertex ids of the receiver}
+        '''
+        from scipy import sparse
+        if end_eid is None:
+            end_eid = self.eid-1
+        DG = self.graph[wavelength][graph_index]
+        edges = np.reshape(DG.get_edgelist(), (-1,2))
+        k = np.reshape(DG.es['k'], (-1,3))
+        veid = np.asarray(DG.vs['eid'])
+        indptr, order = csr(edges[:,0], DG.vcount())
+        pair_in = np.repeat(np.arange(len(edges)), np.diff(indptr)[edges[:,1]])
+        pair_out = order[csr_rows(indptr, edges[:,1])]
+        eid = veid[edges[pair_in,1]]
+        dkxy = (k[pair_out,:2]-k[pair_in,:2])/wavelength
+        mn = np.zeros((len(eid),2))
+        for e in np.unique(eid):
+            g_vectors = getattr(self.elements[e][0], 'g_vectors', np.zeros((2,2)))
+            mn[eid == e] = np.round(dkxy[eid == e] @ np.linalg.pinv(g_vectors))
+            dkxy[eid == e] -= mn[eid == e] @ g_vectors
+        explained = np.sum(np.abs(dkxy),axis = 1) < tolerance
+        rows = np.column_stack((eid, np.where(k[pair_in,2]>=0,1,-1), np.where(k[pair_out,2]>=0,1,-1), mn.astype(int)))[explained]
+        keys, pair_key = np.unique(rows.reshape((-1,5)), axis = 0, return_inverse = True)
+        pair_in, pair_out = pair_in[explained], pair_out[explained]
+
+        default = np.ones(len(keys))
+        for i, (e, in_direct, out_direct, m, n) in enumerate(keys):
+            diff_order = self.path_orders(e).get(in_direct, []) if isinstance(self.elements[e][0], Grating) else []
+            for order in diff_order:
+                if list(order[:3]) == [out_direct, m, n]:
+                    default[i] = order[3]
+
+        receivers = np.flatnonzero(veid == end_eid)
+        hit = np.flatnonzero(veid[edges[:,1]] == end_eid)
+        return {'keys': keys, 'default': default, 'pair_in': pair_in, 'pair_key': pair_key.reshape(-1),
+                'scatter': sparse.csr_matrix((np.ones(len(pair_out)), (pair_out, np.arange(len(pair_out)))), 
+                                             shape = (len(edges), len(pair_out))),
+                'launch': np.flatnonzero(veid[edges[:,0]] == 0),
+                'collect': sparse.csr_matrix((np.ones(len(hit)), (np.searchsorted(receivers, edges[hit,1]), hit)), 
+                                             shape = (len(receivers), len(edges))),
+                'receivers': receivers}
+
+    @staticmethod
+    def eyebox_power(transfer, efficiency = None):
+        '''
+        power delivered to every receiver vertex for a batch of efficiency sets, the power is propagated
+        one interaction per step until it has left the graph (at most the depth of the DAG)
+        transfer: from transfer_matrix
+        efficiency: None (the defaults), {(eid,in_direct,out_direct,m,n): value or [value per set]} 
+                    overriding the defaults, or an array [set,key] in the order of transfer['keys']
+        return: power [set,receiver vertex]
+        '''
+        keys = transfer['keys']
+        if efficiency is None or isinstance(efficiency, dict):
+            efficiency = efficiency or {}
+            batch = max([np.size(value) for value in efficiency.values()], default = 1)
+            table = np.tile(transfer['default'][:,np.newaxis], (1, batch))
+            for i, key in enumerate(map(tuple, keys.tolist())):
+                if key in efficiency:
+                    table[i] = efficiency[key]
+        else:
+            table = np.atleast_2d(efficiency).T
+        x = np.zeros((transfer['scatter'].shape[0], table.shape[1]))
+        x[transfer['launch']] = 1
+        total = x.copy()
+        for _ in range(transfer['scatter'].shape[0]):
+            x = transfer['scatter'] @ (x[transfer['pair_in']]*table[transfer['pair_key']])
+            if not x.any():
+                break
+            total += x
+        return np.asarray(transfer['collect'] @ total).T
 
     def max_area(self,border = 5):
         all_shape = np.vstack([self.elements[i][1].vertices for i in self.elements])
@@ -336,27 +1011,55 @@ class K_domain:
             self.elements[self.eid] = element(**options)
 
     def add_sequence(self,sequence):
-        #sequence = [[eid,order],]
-        if len(sequence)<=3:
-            self.sequences[self.sid] = sequence
-            self.sid += 1
+        '''
+        sequence = [[eid,order],] or [[eid,order,medium],], any number of elements
+        medium: material the order is diffracted into, 0: surrounding, 1: substrate (where the rays must be TIR)
+                default: the last element of a sequence of 3 or more elements couples out to 0, the others stay in 1
+        '''
+        self.sequences[self.sid] = sequence
+        self.sid += 1
+
+    def media(self,sid):
+        #medium of every step of the sequence
+        sequence = self.sequences[sid]
+        default = [0 if i == len(sequence)-1 and len(sequence) >= 3 else 1 for i in range(len(sequence))]
+        return [step[2] if len(step) > 2 else medium for step, medium in zip(sequence, default)]
 
     def elements_info(self):
         for eid in self.elements:
             print(eid,self.elements[eid].name)
 
     def tracing(self,sid_list = None):
+        '''
+        every sequence starts from the source rays (fov x wavelength) and all of them are traced at once,
+        kxy[sequence,step,ray] = kxy_source + wavelength*cumsum(order g-vectors), kz is nan from the first step 
+        that is evanescent or, in the substrate, not TIR
+        self.k_out: {sid: [step,ray,(wavelength,kx,ky,kz)]}, step 0 is the source
+        '''
         if hasattr(self,'source'):
             self.k_out = {}
-            sid_list = sid_list if sid_list else self.sequences.keys()
+            sid_list = list(sid_list if sid_list else self.sequences.keys())
             k_in = self.source.launch()[:,:4]
-            for sid in sid_list:
-                self.k_out[sid] = [k_in]
-                for i,(eid,order) in enumerate(self.sequences[sid]):
-                    idx = 0 if i==2 else 1
-                    k_in = self.elements[eid].launched_k(k_in, order, idx)
-                    self.k_out[sid] += [k_in]
-                self.k_out[sid] = np.array(self.k_out[sid])
+            steps = max([len(self.sequences[sid]) for sid in sid_list], default = 0)
+            #order g-vector and medium of every (sequence, step), the shorter sequences are padded
+            gv = np.zeros((len(sid_list), steps, 2))
+            medium = np.ones((len(sid_list), steps), dtype = int)
+            for s, sid in enumerate(sid_list):
+                for t, (step, m) in enumerate(zip(self.sequences[sid], self.media(sid))):
+                    gv[s,t] = np.asarray(step[1])[-2:] @ self.elements[step[0]].g_vectors
+                    medium[s,t] = m
+            k_out = np.empty((len(sid_list), steps+1, len(k_in), 4))  #[sequence,step,ray,(wavelength,kx,ky,kz)]
+            k_out[:] = k_in
+            k_out[:,1:,:,1:3] += k_in[:,0:1]*np.cumsum(gv, axis = 1)[:,:,np.newaxis]
+            k2xy = k_out[:,1:,:,1]**2+k_out[:,1:,:,2]**2
+            k2z = np.stack((self.index[0](k_in[:,0]), self.index[1](k_in[:,0])))[medium]**2-k2xy
+            #evanescent, or leaking out of the substrate, and every later step of the sequence
+            lost = (k2z < 0) | ((medium[:,:,np.newaxis] == 1) & (k2xy <= 1))
+            np.logical_or.accumulate(lost, axis = 1, out = lost)
+            np.putmask(k2z, lost, np.nan)
+            np.sqrt(k2z, out = k_out[:,1:,:,3])
+            for s, sid in enumerate(sid_list):
+                self.k_out[sid] = k_out[s,:len(self.sequences[sid])+1]
 
     def draw(self,sid_list = None):
         fig, ax = plt.subplots()